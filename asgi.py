@@ -0,0 +1,406 @@
+import io
+import os
+import sys
+import asyncio
+import threading
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+import psycopg
+import pytz
+from psycopg import sql
+from psycopg.pq import TransactionStatus
+from psycopg_pool import AsyncConnectionPool
+from quart import Quart, g, request
+from werkzeug.exceptions import HTTPException
+
+# Importing main loads .env before anything below reads the environment
+from main import app as wsgi_app
+from auth import authorize
+from db import pool_settings
+from events import INSTANT_CHECK_SQL, entry_change_delta
+from json_provider import OrjsonProvider, dumps
+from notify import CHANNEL, NOTIFY_SQL, AsyncSubscription, encode_notification, limit_open_streams, subscribe, unsubscribe
+from versions import BUMP_VERSIONS_SQL
+from qr import (
+    SCAN_ACTIONS,
+    QR_ENTRY_SQL,
+    ISSUE_QR_SQL,
+    UNCLAIMED_QR_SQL,
+    CLAIM_QR_SQL,
+    SCAN_QR_SQL,
+    QR_SCANNED_SQL,
+    QR_SCAN_STATE_SQL,
+    INVALID_QR,
+    INVALID_SCAN_ACTION,
+    WAIT_FOR_MESSAGE,
+    _generate_qrid,
+    qr_entry_error,
+    qr_expiry,
+    qr_scan_steps,
+    unclaimed_qr_error
+)
+
+# Async serving mode, run with "hypercorn asgi:app". The check in routes are
+# served here on an async connection pool, so waiting on Postgres or on a
+# scan does not hold a thread. Every other request goes to the Flask app in
+# main.py, which runs on a pool of WSGI_THREADS threads.
+
+async_app = Quart(__name__, static_folder=None)
+async_app.json = OrjsonProvider(async_app)
+
+_pool: AsyncConnectionPool = None
+
+async def get_db() -> psycopg.AsyncConnection:
+    # One connection and one transaction per request, like db.get_db
+    if 'db' not in g:
+        g.db = await _pool.getconn()
+    return g.db
+
+@async_app.teardown_appcontext
+async def close_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        if exception is None:
+            await conn.commit()
+        else:
+            await conn.rollback()
+    finally:
+        if conn.info.transaction_status == TransactionStatus.INTRANS:
+            await conn.rollback()
+        await _pool.putconn(conn)
+
+async def publish(conn: psycopg.AsyncConnection, key, data):
+    # Same payload as notify.publish, so either mode's listeners can read it
+    await conn.execute(NOTIFY_SQL, (CHANNEL, encode_notification(key, data)))
+
+async def bump_versions(conn: psycopg.AsyncConnection, *names):
+    names = sorted(set(names))
+    await conn.execute(BUMP_VERSIONS_SQL, (names, ))
+    await publish(conn, 'versions', {'names': names})
+
+@async_app.before_serving
+async def _start():
+    global _pool
+    settings = pool_settings()
+    settings['name'] = 'crew-async'
+    _pool = AsyncConnectionPool(
+        os.environ["DATABASE_URL"],
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+        **settings
+    )
+    await _pool.open()
+
+@async_app.after_serving
+async def _stop():
+    await _pool.close()
+
+@async_app.after_request
+async def _allow_origin(response):
+    # What CORS(app, origins='*', send_wildcard=False) does for the Flask app,
+    # preflight requests never reach this app (see _is_async_route)
+    origin = request.headers.get('Origin')
+    if origin:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.vary.add('Origin')
+    return response
+
+def authorization_required(f):
+    @wraps(f)
+    async def wrap(*args, **kwargs):
+        user, error = authorize(request.headers["authorization"])
+        if error:
+            return error
+        g.user = user
+        return await f(*args, **kwargs)
+    return wrap
+
+def admin_only(f):
+    @wraps(f)
+    async def wrap(*args, **kwargs):
+        if not g.user['admin']:
+            return {
+                'success': False,
+                'error': 'Admin Only',
+                'friendly': 'You are not authorized to take this action.'
+            }
+        return await f(*args, **kwargs)
+    return wrap
+
+async def _instant_check(event_id, user_id, change):
+    now = datetime.datetime.now(pytz.utc)
+    conn = await get_db()
+    cur = await conn.execute(INSTANT_CHECK_SQL[change], (now, event_id, user_id))
+    if cur.rowcount:
+        await bump_versions(conn, 'event:' + event_id)
+        await publish(conn, 'dashboard:' + event_id, entry_change_delta(change, [{'uid': user_id, change: now}]))
+    return {
+        'success': True,
+        change: now
+    }
+
+@async_app.get('/event/<event_id>/user/<user_id>/checkin')
+@authorization_required
+@admin_only
+async def check_in(event_id, user_id):
+    return await _instant_check(event_id, user_id, 'check_in')
+
+@async_app.get('/event/<event_id>/user/<user_id>/checkout')
+@authorization_required
+@admin_only
+async def check_out(event_id, user_id):
+    return await _instant_check(event_id, user_id, 'check_out')
+
+@async_app.get('/event/<event_id>/qr')
+@authorization_required
+async def generate_checkin_qr(event_id):
+    conn = await get_db()
+    cur = await conn.execute(QR_ENTRY_SQL, (event_id, g.user['id']))
+    error = qr_entry_error(await cur.fetchone())
+    if error:
+        return error
+
+    exp = qr_expiry()
+    qrid = None
+    while not qrid:
+        cur = await conn.execute(ISSUE_QR_SQL, (_generate_qrid(), event_id, g.user['id'], exp))
+        row = await cur.fetchone()
+        if row:
+            qrid = row['qrid']
+    return {
+        'success': True,
+        'qrid': qrid
+    }
+
+@async_app.get('/scan/qr/<qrid>')
+@authorization_required
+@admin_only
+async def scan_qr_data(qrid):
+    conn = await get_db()
+    cur = await conn.execute(CLAIM_QR_SQL, (qrid, ))
+    data = await cur.fetchone()
+    if not data:
+        cur = await conn.execute(UNCLAIMED_QR_SQL, (qrid, ))
+        return unclaimed_qr_error(await cur.fetchone())
+    await publish(conn, 'qr:' + qrid, {'scanned': True})
+    return {
+        'success': True,
+        'data': data
+    }
+
+@async_app.get('/scan/qr/<qrid>/<action>')
+@authorization_required
+@admin_only
+async def scan_qr_action(qrid, action):
+    if action not in SCAN_ACTIONS:
+        return dict(INVALID_SCAN_ACTION)
+    change = SCAN_ACTIONS[action]
+    conn = await get_db()
+    cur = await conn.execute(SCAN_QR_SQL.format(column=sql.Identifier(change)), (qrid, ))
+    data = await cur.fetchone()
+    if not data:
+        cur = await conn.execute(UNCLAIMED_QR_SQL, (qrid, ))
+        return unclaimed_qr_error(await cur.fetchone())
+    await publish(conn, 'qr:' + qrid, {'scanned': True})
+    await bump_versions(conn, 'event:' + data['eid'])
+    await publish(conn, 'dashboard:' + data['eid'], entry_change_delta(change, [{'uid': data['uid'], change: data[change]}]))
+    return {
+        'success': True,
+        change: data[change],
+        'data': data
+    }
+
+@async_app.get('/qr/<qrid>')
+@authorization_required
+async def check_qrid_scan_state(qrid):
+    conn = await get_db()
+    cur = await conn.execute(QR_SCANNED_SQL, (qrid, g.user['id']))
+    data = await cur.fetchone()
+    return {
+        'success': True,
+        'scanned': bool(data and data['scanned'])
+    }
+
+async def _get_qr_scan_state(qrid, user_id):
+    # Streams outlive the request, so they borrow a connection per read
+    # instead of holding the request's
+    async with _pool.connection() as conn:
+        cur = await conn.execute(QR_SCAN_STATE_SQL, (qrid, user_id))
+        return await cur.fetchone()
+
+@async_app.get('/qr/<qrid>/stream')
+@authorization_required
+async def stream_qrid_scan(qrid):
+    user_id = g.user['id']
+    key = 'qr:' + qrid
+    subscription = subscribe(key, AsyncSubscription())
+    try:
+        state = await _get_qr_scan_state(qrid, user_id)
+    except Exception:
+        unsubscribe(key, subscription)
+        raise
+    if not state:
+        unsubscribe(key, subscription)
+        return dict(INVALID_QR)
+    steps = qr_scan_steps(state, dumps)
+
+    async def stream():
+        try:
+            reply = None
+            while True:
+                try:
+                    step = steps.send(reply)
+                except StopIteration:
+                    return
+                reply = None
+                if isinstance(step, str):
+                    yield step
+                elif step[0] == WAIT_FOR_MESSAGE:
+                    try:
+                        reply = await asyncio.wait_for(subscription.get(), step[1])
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    reply = await _get_qr_scan_state(qrid, user_id)
+        finally:
+            unsubscribe(key, subscription)
+
+    response = async_app.response_class(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # The stream ends by itself when the code expires
+    response.timeout = None
+    return response
+
+# Flask requests run on this many threads at most, the rest wait their turn.
+# Dashboard streams may take half of them, QR streams are served above.
+_wsgi_threads = int(os.getenv('WSGI_THREADS', '32'))
+_wsgi_executor = ThreadPoolExecutor(max_workers=_wsgi_threads, thread_name_prefix='wsgi')
+limit_open_streams(int(os.getenv('MAX_OPEN_STREAMS', _wsgi_threads // 2)))
+_async_routes = async_app.url_map.bind('')
+
+class ClientDisconnected(Exception):
+    pass
+
+def _wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+def _run_wsgi(environ, send, loop, disconnected):
+    # Runs on _wsgi_executor. Every write waits for the event loop to send it,
+    # and fails once the client has left.
+    start = {}
+
+    def send_now(message):
+        if disconnected.is_set():
+            raise ClientDisconnected()
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def write(data):
+        if 'sent' not in start:
+            start['sent'] = True
+            send_now(start['message'])
+        if data:
+            send_now({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and 'sent' in start:
+            raise exc_info[1].with_traceback(exc_info[2])
+        start['message'] = {
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+        }
+        return write
+
+    response = wsgi_app(environ, start_response)
+    try:
+        for data in response:
+            write(data)
+        # Starts the response if the body was empty
+        write(b'')
+        send_now({'type': 'http.response.body'})
+    finally:
+        # Gives a refused or finished stream its slot back (notify.limit_streams)
+        if hasattr(response, 'close'):
+            response.close()
+
+def _is_async_route(scope):
+    # Preflights go to the Flask app, where flask_cors answers them
+    if scope['method'] == 'OPTIONS':
+        return False
+    try:
+        _async_routes.match(scope['path'], method=scope['method'])
+    except HTTPException:
+        return False
+    return True
+
+async def _serve_wsgi(scope, receive, send):
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    # Nothing reads from the client once the body is in, so watch for it
+    # leaving here. A streamed response (the dashboard) then fails its next
+    # write instead of running until its own timeout.
+    disconnected = threading.Event()
+
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch())
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(_wsgi_executor, _run_wsgi, _wsgi_environ(scope, b''.join(body)), send, loop, disconnected)
+    except ClientDisconnected:
+        pass
+    finally:
+        watcher.cancel()
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan' or (scope['type'] == 'http' and _is_async_route(scope)):
+        await async_app(scope, receive, send)
+    else:
+        await _serve_wsgi(scope, receive, send)
\ No newline at end of file
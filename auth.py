@@ -1,21 +1,107 @@
 import os
+import re
+import time
+import hashlib
 import datetime
+import threading
 import jwt
+import requests
 
+from cachetools import TLRUCache
 from functools import wraps
 from flask import g, request
 
-from db import get_db_connection
+from db import get_db
 
-from google.oauth2 import id_token
-from google.auth.transport import requests
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+GOOGLE_ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+GOOGLE_CERTS_DEFAULT_MAX_AGE = 300
+GOOGLE_CERTS_REFRESH_MARGIN = 300
+GOOGLE_CERTS_MIN_REFETCH = 60
+
+# (certs, refresh_at, expires, fetched) on the monotonic clock, replaced as a
+# whole so readers never see a half updated cache
+_google_certs = (None, 0, 0, 0)
+_google_certs_lock = threading.Lock()
+_google_certs_refreshing = False
+_google_session = requests.Session()
+
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '4096'))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '300'))
+
+def _auth_cache_ttu(key, claims, now):
+    expires = now + AUTH_CACHE_TTL
+    if isinstance(claims.get('exp'), (int, float)):
+        # get_exp_ts stores exp in milliseconds
+        expires = min(expires, claims['exp'] / 1000)
+    return expires
+
+_auth_cache = TLRUCache(maxsize=AUTH_CACHE_SIZE, ttu=_auth_cache_ttu, timer=time.time)
+_auth_cache_lock = threading.Lock()
+_auth_cache_hits = 0
+_auth_cache_misses = 0
+
+def _fetch_google_certs():
+    global _google_certs
+    response = _google_session.get(GOOGLE_CERTS_URL, timeout=10)
+    response.raise_for_status()
+    match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+    max_age = int(match.group(1)) if match else GOOGLE_CERTS_DEFAULT_MAX_AGE
+    now = time.monotonic()
+    refresh_at = now + max(max_age - GOOGLE_CERTS_REFRESH_MARGIN, max_age / 2)
+    _google_certs = (response.json(), refresh_at, now + max_age, now)
+
+def _refresh_google_certs():
+    global _google_certs_refreshing
+    try:
+        _fetch_google_certs()
+    except Exception as e:
+        print(e)
+    finally:
+        _google_certs_refreshing = False
+
+def _needs_google_certs_fetch(kid):
+    certs, refresh_at, expires, fetched = _google_certs
+    now = time.monotonic()
+    if certs is None or now >= expires:
+        return True
+    # Google rotated its keys before our copy expired
+    return kid not in certs and now - fetched > GOOGLE_CERTS_MIN_REFETCH
+
+def _get_google_certs(kid):
+    global _google_certs_refreshing
+    if _needs_google_certs_fetch(kid):
+        with _google_certs_lock:
+            # Another login may have fetched them while this one waited
+            if _needs_google_certs_fetch(kid):
+                _fetch_google_certs()
+    certs, refresh_at, expires, fetched = _google_certs
+    # Fetch the next set in the background shortly before this one expires so
+    # logins do not wait on Google
+    if time.monotonic() >= refresh_at and not _google_certs_refreshing:
+        with _google_certs_lock:
+            if not _google_certs_refreshing:
+                _google_certs_refreshing = True
+                threading.Thread(target=_refresh_google_certs, daemon=True).start()
+    return certs
+
+def _verify_google_id_token(token):
+    # Imported on the first login, it pulls in the crypto backends and is not
+    # needed to serve anything else
+    from google.auth import exceptions
+    from google.auth import jwt as google_jwt
+    kid = google_jwt.decode_header(token).get('kid')
+    user_info = google_jwt.decode(token, certs=_get_google_certs(kid), audience=os.getenv('G_OAUTH_WEB_CLIENT_ID'))
+    if user_info['iss'] not in GOOGLE_ISSUERS:
+        raise exceptions.GoogleAuthError('Wrong issuer: ' + user_info['iss'])
+    return user_info
 
 def get_exp_ts():
     return int((datetime.datetime.now() + datetime.timedelta(seconds=302400)).timestamp() * 1000)
 
 def gauth_login(token):
     try:
-        user_info = id_token.verify_oauth2_token(token, requests.Request(), os.getenv('G_OAUTH_WEB_CLIENT_ID'))
+        user_info = _verify_google_id_token(token)
         uid = user_info['email'].split('@')[0]
         return create_auth_token(uid)
     except Exception as e:
@@ -27,11 +113,10 @@ def gauth_login(token):
         }
 
 def create_auth_token(uid):
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute('SELECT * FROM public.users WHERE id = %s', (uid, ))
         row = cur.fetchone()
-    conn.close()
     if row:
         payload = row
         if payload['grade'] == 0:
@@ -57,38 +142,70 @@ def create_auth_token(uid):
         }
 
 def validate_auth_token(token):
-    return jwt.decode(token, os.getenv('JWT_SIGNING_KEY'), 'HS256')
+    global _auth_cache_hits, _auth_cache_misses
+    # Keyed by digest so the cache never holds the tokens themselves
+    key = hashlib.sha256(token.encode()).digest()
+    with _auth_cache_lock:
+        claims = _auth_cache.get(key)
+        if claims is not None:
+            _auth_cache_hits += 1
+            return dict(claims)
+        _auth_cache_misses += 1
+    # Only tokens that decode are cached, failures raise the same errors every time
+    claims = jwt.decode(token, os.getenv('JWT_SIGNING_KEY'), 'HS256')
+    with _auth_cache_lock:
+        _auth_cache[key] = claims
+    return dict(claims)
+
+def get_auth_cache_stats():
+    with _auth_cache_lock:
+        lookups = _auth_cache_hits + _auth_cache_misses
+        return {
+            'size': len(_auth_cache),
+            'maxSize': _auth_cache.maxsize,
+            'hits': _auth_cache_hits,
+            'misses': _auth_cache_misses,
+            'hitRate': _auth_cache_hits / lookups if lookups else 0
+        }
+
+def authorize(token):
+    # Returns the token's claims, or None and the response explaining why
+    # they could not be read. Shared by the decorators here and in asgi.py
+    if not token:
+        return None, {
+            'success': False,
+            'error': 'Identity Unknown',
+            'friendly': 'The server could not identify who you are and whether this action is authorized, try refreshing the page and signing in if required.'
+        }
+    
+    try:
+        return validate_auth_token(token), None
+    except jwt.ExpiredSignatureError:
+        return None, {
+            'success': False,
+            'error': 'Expired Session',
+            'friendly': 'The credentials used to authroize this request have expired, refresh the page, sign in, and try again.'
+        }
+    except jwt.InvalidSignatureError:
+        return None, {
+            'success': False,
+            'error': 'Tampered Token',
+            'friendly': 'The credentials used to authorize this request have been tampered with and are no longer valid. Do not try to hack the matrix, it will not be tolerated.'
+        }
+    except Exception:
+        return None, {
+            'success': False,
+            'error': 'Unknown Error',
+            'friendly': 'The server failed to identify who you are and whether this action is authorized, try refreshing the page and signing in if required.'
+        }
 
 def authorization_required(f):
     @wraps(f)
     def wrap(*args, **kwargs):
-        if not request.headers["authorization"]:
-            return {
-                'success': False,
-                'error': 'Identity Unknown',
-                'friendly': 'The server could not identify who you are and whether this action is authorized, try refreshing the page and signing in if required.'
-            }
-        
-        try:
-            g.user = validate_auth_token(request.headers["authorization"])
-        except jwt.ExpiredSignatureError:
-            return{
-                'success': False,
-                'error': 'Expired Session',
-                'friendly': 'The credentials used to authroize this request have expired, refresh the page, sign in, and try again.'
-            }
-        except jwt.InvalidSignatureError:
-            return {
-                'success': False,
-                'error': 'Tampered Token',
-                'friendly': 'The credentials used to authorize this request have been tampered with and are no longer valid. Do not try to hack the matrix, it will not be tolerated.'
-            }
-        except Exception:
-            return {
-                'success': False,
-                'error': 'Unknown Error',
-                'friendly': 'The server failed to identify who you are and whether this action is authorized, try refreshing the page and signing in if required.'
-            }
+        user, error = authorize(request.headers["authorization"])
+        if error:
+            return error
+        g.user = user
         return f(*args, **kwargs)
     return wrap
 
@@ -115,4 +232,6 @@ def inject_user(f):
     return wrap
 
 if __name__ == '__main__':
-    print(create_auth_token('dfllanagan'))
\ No newline at end of file
+    from main import app
+    with app.app_context():
+        print(create_auth_token('dfllanagan'))
\ No newline at end of file
@@ -0,0 +1,303 @@
+import os
+import time
+
+import psycopg
+from psycopg.types.json import Jsonb
+
+from db import get_db, get_db_connection, release_db_connection
+
+# The Google client (gapi, googleapiclient) is only imported by the functions
+# that talk to Calendar, so web workers that only enqueue changes never load it
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETENTION_DAYS = 7
+CALENDAR_BATCH_SIZE = 50
+
+# First key of the per-event advisory locks, the second is the event id's hash
+CALENDAR_LOCK_CLASS = 7305129
+
+def enqueue_calendar_change(event_id, op, payload=None, conn: psycopg.Connection = None):
+    # Written on the request's connection so the change commits or rolls back
+    # together with the database write it mirrors
+    if conn is None:
+        conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(
+            'INSERT INTO public.calendar_outbox (eid, op, payload) VALUES (%s, %s, %s)',
+            (event_id, op, Jsonb(payload or {}))
+        )
+
+def _coalesce_changes(changes):
+    create = None
+    fields = {}
+    delete = False
+    add = {}
+    remove = {}
+    for change in changes:
+        payload = change['payload']
+        if change['op'] == 'create':
+            create = dict(payload)
+        elif change['op'] == 'update':
+            fields.update(payload)
+        elif change['op'] == 'delete':
+            delete = True
+        elif change['op'] == 'attendees':
+            for email in payload.get('add', []):
+                remove.pop(email, None)
+                add[email] = True
+            for email in payload.get('remove', []):
+                add.pop(email, None)
+                remove[email] = True
+    if create is not None:
+        create.update(fields)
+        fields = create
+    return {
+        'create': create is not None,
+        'fields': fields,
+        'delete': delete,
+        'add': list(add),
+        'remove': list(remove)
+    }
+
+def _apply_fields(google_event, fields):
+    if 'title' in fields:
+        google_event['summary'] = fields['title']
+    if 'start' in fields:
+        google_event.setdefault('start', {})['dateTime'] = fields['start']
+    if 'end' in fields:
+        google_event.setdefault('end', {})['dateTime'] = fields['end']
+
+def _apply_attendees(google_event, add, remove):
+    attendees = [guest for guest in google_event.get('attendees', []) if guest['email'] not in remove]
+    present = {guest['email'] for guest in attendees}
+    for email in add:
+        if email not in present:
+            attendees.append({'email': email})
+    google_event['attendees'] = attendees
+
+def _execute_batch(calendar_api, requests):
+    # Sends the requests through Google's batch endpoint, a few dozen per HTTP
+    # call, and returns each request's (response, exception) by key
+    results = {}
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+    for start in range(0, len(requests), CALENDAR_BATCH_SIZE):
+        batch = calendar_api.new_batch_http_request(callback=callback)
+        for key, request in requests[start:start + CALENDAR_BATCH_SIZE]:
+            batch.add(request, request_id=key)
+        batch.execute()
+    return results
+
+def _calendar_id():
+    return os.environ['G_CAL_ID']
+
+def _http_status(exception):
+    from googleapiclient.errors import HttpError
+    if isinstance(exception, HttpError):
+        return exception.resp.status
+    return None
+
+def _patch_existing_event(calendar_api, event_id, change):
+    google_event = calendar_api.events().get(calendarId=_calendar_id(), eventId=event_id, fields='attendees').execute()
+    body = {}
+    _apply_fields(body, change['fields'])
+    body['attendees'] = google_event.get('attendees', [])
+    _apply_attendees(body, change['add'], change['remove'])
+    calendar_api.events().patch(calendarId=_calendar_id(), eventId=event_id, body=body, sendUpdates='all').execute()
+
+# Applies coalesced changes keyed by event id and returns errors keyed the same
+# way. Each event gets at most one write, and the reads and writes of several
+# events share batch requests.
+def sync_calendar_events(calendar_api, changes):
+    errors = {}
+
+    # Patching attendees replaces the whole list, so the current one is needed
+    reads = []
+    for event_id, change in changes.items():
+        if not change['delete'] and not change['create'] and (change['add'] or change['remove']):
+            reads.append((event_id, calendar_api.events().get(calendarId=_calendar_id(), eventId=event_id, fields='attendees')))
+    current = {}
+    for event_id, (response, exception) in _execute_batch(calendar_api, reads).items():
+        if exception is not None:
+            errors[event_id] = exception
+        else:
+            current[event_id] = response
+
+    writes = []
+    for event_id, change in changes.items():
+        if event_id in errors:
+            continue
+        if change['delete']:
+            if change['create']:
+                # Created and deleted before the worker got to it
+                continue
+            writes.append((event_id, calendar_api.events().delete(calendarId=_calendar_id(), eventId=event_id, sendUpdates='all')))
+        elif change['create']:
+            body = {'id': event_id}
+            _apply_fields(body, change['fields'])
+            _apply_attendees(body, change['add'], change['remove'])
+            writes.append((event_id, calendar_api.events().insert(calendarId=_calendar_id(), body=body, sendUpdates='all')))
+        else:
+            body = {}
+            _apply_fields(body, change['fields'])
+            if event_id in current:
+                body['attendees'] = current[event_id].get('attendees', [])
+                _apply_attendees(body, change['add'], change['remove'])
+            if body:
+                writes.append((event_id, calendar_api.events().patch(calendarId=_calendar_id(), eventId=event_id, body=body, sendUpdates='all')))
+
+    for event_id, (response, exception) in _execute_batch(calendar_api, writes).items():
+        if exception is None:
+            continue
+        change = changes[event_id]
+        status = _http_status(exception)
+        if change['delete'] and status in (404, 410):
+            continue
+        if change['create'] and status == 409:
+            # An earlier attempt created the event before failing, patch it instead
+            try:
+                _patch_existing_event(calendar_api, event_id, change)
+            except Exception as e:
+                errors[event_id] = e
+            continue
+        errors[event_id] = exception
+    return errors
+
+def _group_by_event(rows):
+    events = {}
+    for row in rows:
+        events.setdefault(row['eid'], []).append(row)
+    return events
+
+def drain_calendar_outbox(limit=OUTBOX_BATCH_SIZE):
+    from gapi import get_calendar_api
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            # Workers claim whole events, a row lock would let a second worker
+            # take a change committed after the first one started and patch the
+            # same attendee list at the same time. Events another worker holds
+            # are skipped until its transaction ends.
+            cur.execute(
+                """
+                SELECT eid FROM public.calendar_outbox
+                WHERE status = 'pending' AND next_attempt <= now()
+                GROUP BY eid
+                ORDER BY min(id)
+                LIMIT %s
+                """,
+                (limit, )
+            )
+            candidates = [row['eid'] for row in cur.fetchall()]
+            cur.execute(
+                'SELECT eid FROM unnest(%s::text[]) AS eid WHERE pg_try_advisory_xact_lock(%s, hashtext(eid))',
+                (candidates, CALENDAR_LOCK_CLASS)
+            )
+            claimed = [row['eid'] for row in cur.fetchall()]
+            # Every pending change of a claimed event is taken together, even
+            # ones still backing off, so they are applied in order as a single
+            # update
+            cur.execute(
+                "SELECT id, eid, op, payload FROM public.calendar_outbox WHERE status = 'pending' AND eid = ANY(%s) ORDER BY id",
+                (claimed, )
+            )
+            rows = cur.fetchall()
+            if rows:
+                changes = _group_by_event(rows)
+                coalesced = {event_id: _coalesce_changes(event_changes) for event_id, event_changes in changes.items()}
+                try:
+                    errors = sync_calendar_events(get_calendar_api(), coalesced)
+                except Exception as e:
+                    errors = {event_id: e for event_id in coalesced}
+                done = []
+                for event_id, event_changes in changes.items():
+                    ids = [change['id'] for change in event_changes]
+                    if event_id not in errors:
+                        done.extend(ids)
+                        continue
+                    print(errors[event_id])
+                    cur.execute(
+                        """
+                        UPDATE public.calendar_outbox SET
+                            attempts = attempts + 1,
+                            status = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'pending' END,
+                            next_attempt = now() + least(interval '5 seconds' * power(2, attempts), interval '1 hour'),
+                            last_error = %s
+                        WHERE id = ANY(%s)
+                        """,
+                        (OUTBOX_MAX_ATTEMPTS, str(errors[event_id]), ids)
+                    )
+                cur.execute(
+                    "UPDATE public.calendar_outbox SET status = 'done', processed = now() WHERE id = ANY(%s)",
+                    (done, )
+                )
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return len(rows)
+
+def prune_calendar_outbox(days=OUTBOX_RETENTION_DAYS):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM public.calendar_outbox WHERE status = 'done' AND processed < now() - interval '1 day' * %s",
+                (days, )
+            )
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+def run_calendar_worker(poll_interval=None):
+    from gapi import get_calendar_api
+    if poll_interval is None:
+        poll_interval = float(os.getenv('CALENDAR_POLL_INTERVAL', '2'))
+    try:
+        # Load credentials and the discovery document before the first change arrives
+        get_calendar_api()
+    except Exception as e:
+        print(e)
+    last_prune = 0
+    while True:
+        try:
+            processed = drain_calendar_outbox()
+            if time.monotonic() - last_prune > 3600:
+                prune_calendar_outbox()
+                last_prune = time.monotonic()
+        except Exception as e:
+            print(e)
+            processed = 0
+        if not processed:
+            time.sleep(poll_interval)
+
+def get_calendar_sync_status():
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT
+                count(*) FILTER (WHERE status = 'pending') AS pending,
+                count(*) FILTER (WHERE status = 'failed') AS failed,
+                min(created) FILTER (WHERE status = 'pending') AS oldest_pending
+            FROM public.calendar_outbox
+            WHERE status <> 'done'
+            """
+        )
+        counts = cur.fetchone()
+        cur.execute(
+            """
+            SELECT id, eid, op, status, attempts, next_attempt, last_error FROM public.calendar_outbox
+            WHERE status <> 'done' AND attempts > 0
+            ORDER BY id DESC
+            LIMIT 20
+            """
+        )
+        errors = cur.fetchall()
+    return {
+        'success': True,
+        'pending': counts['pending'],
+        'failed': counts['failed'],
+        'oldestPending': counts['oldest_pending'],
+        'errors': errors
+    }
\ No newline at end of file
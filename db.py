@@ -1,6 +1,90 @@
 import os
+import atexit
+import threading
+
 import psycopg
+from flask import g
+from psycopg.pq import TransactionStatus
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool_settings():
+    # Shared with the async pool in asgi.py
+    return {
+        # UTC sessions so every timestamp read back has the same offset
+        'kwargs': {'row_factory': dict_row, 'options': '-c TimeZone=UTC'},
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', '300')),
+        'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', '1800')),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        'name': 'crew'
+    }
+
+def _create_pool() -> ConnectionPool:
+    return ConnectionPool(
+        os.environ["DATABASE_URL"],
+        check=ConnectionPool.check_connection,
+        open=True,
+        **pool_settings()
+    )
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool()
+                atexit.register(_pool.close)
+    return _pool
 
 def get_db_connection() -> psycopg.Connection:
-    return psycopg.connect(os.environ["DATABASE_URL"], row_factory=dict_row)
\ No newline at end of file
+    return get_pool().getconn()
+
+def release_db_connection(conn: psycopg.Connection):
+    # Read-only helpers never commit, end their transaction before handing back
+    if conn.info.transaction_status == TransactionStatus.INTRANS:
+        conn.rollback()
+    get_pool().putconn(conn)
+
+def get_pool_stats():
+    return get_pool().get_stats()
+
+def ping_db(timeout=None):
+    if timeout is None:
+        timeout = float(os.getenv('READY_TIMEOUT', '2'))
+    # Fails if no connection can be had in time, the first call also opens
+    # the worker's pool
+    with get_pool().connection(timeout=timeout) as conn:
+        conn.execute('SELECT 1')
+
+def insert_with_new_id(cur: psycopg.Cursor, query, new_id, params):
+    # The query takes the new id first, inserts ON CONFLICT DO NOTHING and
+    # returns the row it inserted. A colliding id inserts nothing and returns
+    # no row, so retry with another.
+    while True:
+        cur.execute(query, (new_id(), *params))
+        row = cur.fetchone()
+        if row:
+            return row
+
+def get_db() -> psycopg.Connection:
+    # One connection and one transaction per request, checked out on first use
+    if 'db' not in g:
+        g.db = get_db_connection()
+    return g.db
+
+def close_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        if exception is None:
+            conn.commit()
+        else:
+            conn.rollback()
+    finally:
+        release_db_connection(conn)
\ No newline at end of file
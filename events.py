@@ -1,18 +1,29 @@
-import os
+import json
+import time
+import queue
+import base64
 import secrets
 import datetime
 from typing import Dict
 
 from dateutil.parser import parse
+from flask import current_app
+import psycopg
 import pytz
 
-from db import get_db_connection
-from gapi import get_calendar_api
+from db import get_db, insert_with_new_id
+from calendar_sync import enqueue_calendar_change
+from notify import RESYNC, SSE_HEARTBEAT, publish, subscribe, unsubscribe, format_sse, sse_response, limit_streams
+from versions import bump_versions, bump_all_events
 
 RESERVED_PERIODS = [1]
 
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+DASHBOARD_STREAM_TIMEOUT = 3600
+
 PACIFIC_TIME = pytz.timezone('US/Pacific')
-CALENDAR_ID = os.environ['G_CAL_ID']
 
 def globalize_time_str(timestr) -> datetime.datetime:
     local = PACIFIC_TIME.localize(parse(timestr))
@@ -33,13 +44,22 @@ def get_str_day(time_obj: datetime.datetime) -> str:
         return ts[1:]
     return ts
 
+def _get_user_email(user_id):
+    return user_id + '@fjuhsd.org'
+
+def _get_calendar_fields(event):
+    return {
+        'title': event['title'],
+        'start': event['start'].isoformat(),
+        'end': event['end'].isoformat()
+    }
+
 def _normalize_limit(limit):
     if limit == '' or int(limit) == 0:
         return None
     return int(limit)
 
 def new_event(payload):
-    calendar_api = get_calendar_api()
     event = {
         'title': payload['eventTitle'],
         'start': globalize_time_str(payload['date'] + ' ' + payload['startTime']),
@@ -48,36 +68,26 @@ def new_event(payload):
         'reserved': _normalize_limit(payload['reserved']),
         'id': ''
     }
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
-        eventId = None
-        while not eventId:
-            eventId = secrets.token_hex(4)
-            cur.execute('SELECT * FROM public.events WHERE id = %s', (eventId, ))
-            row = cur.fetchone()
-            if row:
-                eventId = None
-            else:
-                event['id'] = eventId
-        cur.execute(
-            'INSERT INTO public.events (id, title, start, "end", "limit", "reserved") VALUES (%s, %s, %s, %s, %s, %s)',
-            (event['id'], event['title'], event['start'], event['end'], event['limit'], event['reserved'])
+        row = insert_with_new_id(
+            cur,
+            """
+            WITH inserted AS (
+                INSERT INTO public.events (id, title, start, "end", "limit", "reserved") VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (id) DO NOTHING
+                RETURNING id
+            )
+            INSERT INTO public.event_occupancy (eid) SELECT id FROM inserted RETURNING eid
+            """,
+            lambda: secrets.token_hex(4),
+            (event['title'], event['start'], event['end'], event['limit'], event['reserved'])
         )
-        conn.commit()
-    conn.close()
-
-    google_event = {
-        'summary': event['title'],
-        'start': {
-            'dateTime': event['start'].isoformat()
-        },
-        'end' : {
-            'dateTime': event['end'].isoformat()
-        },
-        'id': eventId
-    }
+    eventId = row['eid']
+    event['id'] = eventId
+    bump_versions('event:' + eventId)
 
-    calendar_api.events().insert(calendarId=os.environ['G_CAL_ID'], body=google_event).execute()
+    enqueue_calendar_change(eventId, 'create', _get_calendar_fields(event))
 
     return {
         'success': True,
@@ -85,7 +95,6 @@ def new_event(payload):
     }
 
 def edit_event(event_id, payload):
-    calendar_api = get_calendar_api()
     event = {
         'title': payload['eventTitle'],
         'start': globalize_time_str(payload['date'] + ' ' + payload['startTime']),
@@ -94,31 +103,42 @@ def edit_event(event_id, payload):
         'reserved': _normalize_limit(payload['reserved']),
         'id': event_id
     }
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
             'UPDATE public.events SET title = %s, start = %s, "end" = %s, "limit" = %s, "reserved" = %s WHERE id = %s',
             (event['title'], event['start'], event['end'], event['limit'], event['reserved'], event['id'])
         )
-        conn.commit()
-    conn.close()
+    bump_versions('event:' + event_id)
 
-    google_event = calendar_api.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
-    google_event['summary'] = event['title']
-    google_event['start']['dateTime'] = event['start'].isoformat()
-    google_event['end']['dateTime'] = event['end'].isoformat()
-    calendar_api.events().update(calendarId=CALENDAR_ID, eventId=event_id, body=google_event, sendUpdates='all').execute()
+    enqueue_calendar_change(event_id, 'update', _get_calendar_fields(event))
 
     return {
         'success': True
     }
 
-def get_event_row(event_id):
-    conn = get_db_connection()
+def get_event_row(event_id, user_id=None, conn: psycopg.Connection = None):
+    if conn is None:
+        conn = get_db()
     with conn.cursor() as cur:
-        cur.execute('SELECT * FROM public.events WHERE id = %s', (event_id, ))
+        # Given a user, joined says whether they are already in the event so
+        # the event page is answered by this one query
+        cur.execute(
+            """
+            SELECT
+                public.events.*,
+                coalesce(filled, 0) AS filled,
+                coalesce(reserve_filled, 0) AS reserve_filled,
+                CASE WHEN %(uid)s::text IS NULL THEN NULL
+                    ELSE EXISTS (SELECT 1 FROM public.entries WHERE public.entries.eid = public.events.id AND uid = %(uid)s)
+                END AS joined
+            FROM public.events
+            LEFT JOIN public.event_occupancy ON public.event_occupancy.eid = id
+            WHERE id = %(eid)s
+            """,
+            {'eid': event_id, 'uid': user_id}
+        )
         row = cur.fetchone()
-    conn.close()
     if row:
         return row
     return None
@@ -136,25 +156,21 @@ def get_event_data(row):
         'reserved': row.get('reserved', 0)
     }
 
-def get_limit_entries(event_id):
-    conn = get_db_connection()
+def is_event_member(event_id, user_id):
+    conn = get_db()
     with conn.cursor() as cur:
-        cur.execute('SELECT uid, period FROM public.entries JOIN public.users ON uid = id WHERE eid = %s', (event_id, ))
-        entries = cur.fetchall()
-    conn.close()
-    return entries
+        cur.execute(
+            'SELECT EXISTS (SELECT 1 FROM public.entries WHERE eid = %s AND uid = %s) AS joined',
+            (event_id, user_id)
+        )
+        row = cur.fetchone()
+    return row['joined']
 
-def get_event_limits(row, entries):
+def _event_limits_from_counts(row, filled, reserve_filled):
     if row['limit'] is None:
         row['limit'] = -1
     if row['reserved'] is None:
         row['reserved'] = 0
-    filled = 0
-    reserve_filled = 0
-    for entry in entries:
-        filled += 1
-        if entry['period'] in RESERVED_PERIODS:
-            reserve_filled += 1
     event_limits = {
         'max': row['limit'],
         'reserved': row['reserved'],
@@ -163,17 +179,19 @@ def get_event_limits(row, entries):
     }
     return event_limits
 
-def get_user_event_limits(event_limits, entries, user):
+def get_event_limits(row):
+    return _event_limits_from_counts(row, row['filled'], row['reserve_filled'])
+
+def _user_event_limits_from_counts(event_limits, filled, joined, user):
     user_event_limits = {
         'user_available': True,
         'user_justification': 'Join Event'
     }
-    for entry in entries:
-        if user['id'] == entry['uid']:
-            user_event_limits['user_available'] = False
-            user_event_limits['user_justification'] = 'Already Joined Event'
-            return user_event_limits
-    if len(entries) >= event_limits['max']:
+    if joined:
+        user_event_limits['user_available'] = False
+        user_event_limits['user_justification'] = 'Already Joined Event'
+        return user_event_limits
+    if filled >= event_limits['max']:
         user_event_limits['user_available'] = False
         user_event_limits['user_justification'] = 'Event is Full'
         return user_event_limits
@@ -184,96 +202,296 @@ def get_user_event_limits(event_limits, entries, user):
     
     return user_event_limits
 
-def _add_email_to_gcal(event_id, email):
-    calendar_api = get_calendar_api()
-    event = calendar_api.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
-    if 'attendees' not in event.keys():
-        event['attendees'] = [{'email': email}]
-    else:
-        for guest in event['attendees']:
-            if guest['email'] == email:
-                return
-        event['attendees'].append({'email': email})
-    calendar_api.events().update(calendarId=CALENDAR_ID, eventId=event_id, body=event, sendUpdates='all').execute()
-
-def _remove_email_from_gcal(event_id, email):
-    calendar_api = get_calendar_api()
-    event = calendar_api.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
-    if 'attendees' not in event.keys():
-        return
-    else:
-        replacement = []
-        for guest in event['attendees']:
-            if guest['email'] == email:
-               continue
-            else:
-                replacement.append(guest)
-        event['attendees'] = replacement
-    calendar_api.events().update(calendarId=CALENDAR_ID, eventId=event_id, body=event, sendUpdates='all').execute()
+def get_user_event_limits(event_limits, row, user):
+    joined = row.get('joined')
+    if joined is None:
+        joined = is_event_member(row['id'], user['id'])
+    return _user_event_limits_from_counts(event_limits, row['filled'], joined, user)
 
 def join_event(event_id, user, admin=False):
-    row = get_event_row(event_id)
-    entries = get_limit_entries(event_id)
-    event_limits = get_event_limits(row, entries)
     if admin:
         user['period'] = 10
-    user_event_limits = get_user_event_limits(event_limits, entries, user)
-    if user_event_limits['user_available'] or admin:
-        if admin and not user_event_limits['user_available'] and user_event_limits['user_justification'] == 'Already Joined Event':
-            return {
-                'success': False,
-                'error': 'Failed to Add to Event',
-                'friendly': 'User is already a member of the event.'
-            }
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(
-                'INSERT INTO public.entries (uid, eid) VALUES (%s, %s)',
-                (user['id'], event_id, )
+    conn = get_db()
+    # Lock the event row so concurrent joins are decided one at a time, then
+    # decide and insert in a single statement that sees every earlier join.
+    # Both statements go out in one round trip.
+    with conn.pipeline():
+        conn.execute('SELECT id FROM public.events WHERE id = %s FOR UPDATE', (event_id, ))
+        cur = conn.execute(
+            """
+            WITH event AS (
+                SELECT
+                    coalesce("limit", -1) AS max,
+                    coalesce(reserved, 0) AS reserved,
+                    coalesce(filled, 0) AS filled,
+                    coalesce(reserve_filled, 0) AS reserve_filled,
+                    EXISTS (SELECT 1 FROM public.entries WHERE eid = %(eid)s AND uid = %(uid)s) AS joined
+                FROM public.events
+                LEFT JOIN public.event_occupancy ON eid = id
+                WHERE id = %(eid)s
+            ), verdict AS (
+                SELECT
+                    CASE
+                        WHEN joined THEN 'Already Joined Event'
+                        WHEN filled >= max THEN 'Event is Full'
+                        WHEN max - filled <= greatest(reserved - reserve_filled, 0)
+                            AND NOT %(period)s = ANY(%(reserved_periods)s) THEN 'Remaining Positions Reserved'
+                    END AS justification
+                FROM event
+            ), inserted AS (
+                INSERT INTO public.entries (uid, eid)
+                SELECT %(uid)s, %(eid)s FROM verdict
+                WHERE justification IS NULL OR (%(admin)s AND justification <> 'Already Joined Event')
+                RETURNING uid
+            ), counted AS (
+                INSERT INTO public.event_occupancy AS occupancy (eid, filled, reserve_filled)
+                SELECT %(eid)s, count(*), count(*) FILTER (WHERE period = ANY(%(reserved_periods)s))
+                FROM inserted JOIN public.users ON uid = id
+                HAVING count(*) > 0
+                ON CONFLICT (eid) DO UPDATE SET
+                    filled = occupancy.filled + EXCLUDED.filled,
+                    reserve_filled = occupancy.reserve_filled + EXCLUDED.reserve_filled
             )
-            conn.commit()
-        conn.close()
-        
-        _add_email_to_gcal(event_id, user['id']+'@fjuhsd.org')
+            SELECT justification, EXISTS (SELECT 1 FROM inserted) AS inserted FROM verdict
+            """,
+            {
+                'eid': event_id,
+                'uid': user['id'],
+                'period': user['period'],
+                'admin': admin,
+                'reserved_periods': RESERVED_PERIODS
+            }
+        )
+        row = cur.fetchone()
+    if not row:
+        return {
+            'success': False,
+            'error': 'Failed to Join Event',
+            'friendly': 'Unable to verify your elgibility to join this event: Invalid Event'
+        }
+    if row['inserted']:
+        enqueue_calendar_change(event_id, 'attendees', {'add': [_get_user_email(user['id'])]})
+        bump_versions('event:' + event_id)
+        _publish_joined(event_id, [user['id']])
 
         return {
             'success': True
         }
-    else:
+    if admin and row['justification'] == 'Already Joined Event':
         return {
             'success': False,
-            'error': 'Failed to Join Event',
-            'friendly': 'Unable to verify your elgibility to join this event: ' + user_event_limits['user_justification']
+            'error': 'Failed to Add to Event',
+            'friendly': 'User is already a member of the event.'
+        }
+    return {
+        'success': False,
+        'error': 'Failed to Join Event',
+        'friendly': 'Unable to verify your elgibility to join this event: ' + row['justification']
+    }
+
+def _is_user_id_list(user_ids):
+    return isinstance(user_ids, list) and all(isinstance(user_id, str) for user_id in user_ids)
+
+def _invalid_user_list():
+    return {
+        'success': False,
+        'error': 'Invalid User List',
+        'friendly': 'The list of users to update could not be read, try again.'
+    }
+
+def add_users_to_event(event_id, user_ids, override=False):
+    if not _is_user_id_list(user_ids):
+        return _invalid_user_list()
+    user_ids = list(dict.fromkeys(user_ids))
+    conn = get_db()
+    # Same locking as join_event, the counts are read after the lock is held
+    with conn.pipeline():
+        conn.execute('SELECT id FROM public.events WHERE id = %s FOR UPDATE', (event_id, ))
+        event_cur = conn.execute(
+            'SELECT public.events.*, coalesce(filled, 0) AS filled, coalesce(reserve_filled, 0) AS reserve_filled FROM public.events LEFT JOIN public.event_occupancy ON eid = id WHERE id = %s',
+            (event_id, )
+        )
+        users_cur = conn.execute(
+            'SELECT id, period, EXISTS (SELECT 1 FROM public.entries WHERE eid = %s AND uid = id) AS joined FROM public.users WHERE id = ANY(%s)',
+            (event_id, user_ids)
+        )
+        row = event_cur.fetchone()
+        users = {user['id']: user for user in users_cur.fetchall()}
+    if not row:
+        return {
+            'success': False,
+            'error': 'Invalid Event',
+            'friendly': 'There is no record of this event.'
         }
 
+    filled = row['filled']
+    reserve_filled = row['reserve_filled']
+    added = []
+    results = []
+    for user_id in user_ids:
+        user = users.get(user_id)
+        friendly = None
+        if not user:
+            friendly = 'There is no record of this user.'
+        elif user['joined']:
+            friendly = 'User is already a member of the event.'
+        elif not override:
+            event_limits = _event_limits_from_counts(row, filled, reserve_filled)
+            user_event_limits = _user_event_limits_from_counts(event_limits, filled, False, user)
+            if not user_event_limits['user_available']:
+                friendly = 'Unable to add this user to the event: ' + user_event_limits['user_justification']
+        if friendly:
+            results.append({
+                'id': user_id,
+                'success': False,
+                'error': 'Failed to Add to Event',
+                'friendly': friendly
+            })
+            continue
+        added.append(user_id)
+        filled += 1
+        if user['period'] in RESERVED_PERIODS:
+            reserve_filled += 1
+        results.append({
+            'id': user_id,
+            'success': True
+        })
+
+    if added:
+        conn.execute(
+            """
+            WITH inserted AS (
+                INSERT INTO public.entries (uid, eid)
+                SELECT uid, %(eid)s FROM unnest(%(uids)s::text[]) AS uid
+                RETURNING uid
+            )
+            INSERT INTO public.event_occupancy AS occupancy (eid, filled, reserve_filled)
+            SELECT %(eid)s, count(*), count(*) FILTER (WHERE period = ANY(%(reserved_periods)s))
+            FROM inserted JOIN public.users ON uid = id
+            ON CONFLICT (eid) DO UPDATE SET
+                filled = occupancy.filled + EXCLUDED.filled,
+                reserve_filled = occupancy.reserve_filled + EXCLUDED.reserve_filled
+            """,
+            {
+                'eid': event_id,
+                'uids': added,
+                'reserved_periods': RESERVED_PERIODS
+            }
+        )
+        enqueue_calendar_change(event_id, 'attendees', {'add': [_get_user_email(user_id) for user_id in added]})
+        bump_versions('event:' + event_id)
+        _publish_joined(event_id, added)
+    return {
+        'success': True,
+        'results': results
+    }
+
 def get_event_dashboard(event_id):
-    conn = get_db_connection()
+    event_data_row = get_event_row(event_id)
+    event_data = get_event_data(event_data_row)
+    conn = get_db()
     with conn.cursor() as cur:
-        cur.execute('SELECT * FROM public.events WHERE id = %s', (event_id, ))
-        event_data_row = cur.fetchone()
-        event_data = get_event_data(event_data_row)
         cur.execute(
             'SELECT * FROM public.entries JOIN public.users ON uid = id WHERE eid = %s', 
             (event_id, ))
         entries = cur.fetchall()
-    conn.close()
     return {
         'success': True,
         'eventData': event_data,
         'entries': entries,
-        'eventLimits': get_event_limits(event_data_row, entries)
+        'eventLimits': get_event_limits(event_data_row)
     }
 
-def instant_check_in(event_id, user_id):
-    now = datetime.datetime.now(pytz.utc)
-    conn = get_db_connection()
+# Dashboard deltas are merged into the snapshot by uid, entries only carry the
+# fields that changed except on join
+def entry_change_delta(change, entries, event_limits=None):
+    delta = {
+        'type': change,
+        'entries': entries
+    }
+    if event_limits is not None:
+        delta['eventLimits'] = event_limits
+    return delta
+
+def publish_entry_change(event_id, change, entries, event_limits=None, conn: psycopg.Connection = None):
+    publish('dashboard:' + event_id, entry_change_delta(change, entries, event_limits), conn=conn)
+
+def _publish_joined(event_id, user_ids):
+    # Only the uids are sent, the rows of a large crew would not fit in a
+    # notification. Each dashboard stream reads them (_get_joined_entries).
+    row = get_event_row(event_id)
+    publish('dashboard:' + event_id, {
+        'type': 'join',
+        'uids': user_ids,
+        'eventLimits': get_event_limits(row)
+    })
+
+def _get_joined_entries(event_id, user_ids):
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
-            'UPDATE public.entries SET check_in = %s WHERE eid = %s AND uid = %s',
-            (now, event_id, user_id)
+            'SELECT * FROM public.entries JOIN public.users ON uid = id WHERE eid = %s AND uid = ANY(%s)',
+            (event_id, user_ids)
         )
-        conn.commit()
-    conn.close()
+        return cur.fetchall()
+
+@limit_streams
+def stream_event_dashboard(event_id):
+    key = 'dashboard:' + event_id
+    subscription = subscribe(key)
+    try:
+        snapshot = get_event_dashboard(event_id)
+    except Exception:
+        unsubscribe(key, subscription)
+        raise
+    app = current_app._get_current_object()
+
+    def stream():
+        try:
+            yield format_sse(app.json.dumps(snapshot), event='snapshot')
+            # Browsers reconnect on their own and get a fresh snapshot
+            deadline = time.monotonic() + DASHBOARD_STREAM_TIMEOUT
+            while True:
+                # Queue.get rejects a negative timeout, so the deadline is
+                # read once and checked before waiting
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    message = subscription.get(timeout=min(SSE_HEARTBEAT, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if message is RESYNC:
+                    with app.app_context():
+                        data = get_event_dashboard(event_id)
+                    yield format_sse(app.json.dumps(data), event='snapshot')
+                    continue
+                if message['type'] == 'join':
+                    with app.app_context():
+                        entries = _get_joined_entries(event_id, message['uids'])
+                    message = entry_change_delta('join', entries, message['eventLimits'])
+                yield format_sse(app.json.dumps(message), event='delta')
+                if message['type'] == 'event_removed':
+                    return
+        finally:
+            unsubscribe(key, subscription)
+    return sse_response(stream())
+
+# Also run by the async check in routes in asgi.py
+INSTANT_CHECK_SQL = {
+    'check_in': 'UPDATE public.entries SET check_in = %s WHERE eid = %s AND uid = %s',
+    'check_out': 'UPDATE public.entries SET check_out = %s WHERE eid = %s AND uid = %s'
+}
+
+def instant_check_in(event_id, user_id):
+    now = datetime.datetime.now(pytz.utc)
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(INSTANT_CHECK_SQL['check_in'], (now, event_id, user_id))
+        if cur.rowcount:
+            bump_versions('event:' + event_id)
+            publish_entry_change(event_id, 'check_in', [{'uid': user_id, 'check_in': now}])
     return {
         'success': True,
         'check_in': now
@@ -281,14 +499,12 @@ def instant_check_in(event_id, user_id):
 
 def instant_check_out(event_id, user_id):
     now = datetime.datetime.now(pytz.utc)
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
-        cur.execute(
-            'UPDATE public.entries SET check_out = %s WHERE eid = %s AND uid = %s',
-            (now, event_id, user_id)
-        )
-        conn.commit()
-    conn.close()
+        cur.execute(INSTANT_CHECK_SQL['check_out'], (now, event_id, user_id))
+        if cur.rowcount:
+            bump_versions('event:' + event_id)
+            publish_entry_change(event_id, 'check_out', [{'uid': user_id, 'check_out': now}])
     return {
         'success': True,
         'check_out': now
@@ -311,14 +527,21 @@ def edit_entry(event_id, user_id, payload):
             cin = base_date.replace(**_unwrap_time_input(payload['check_in'])).astimezone(pytz.utc)
         if payload['check_out']:
             cout = base_date.replace(**_unwrap_time_input(payload['check_out'])).astimezone(pytz.utc)
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
             'UPDATE public.entries SET check_in = %s, check_out = %s, position = %s, private_note = %s WHERE uid = %s AND eid = %s',
             (cin, cout, payload['role'], payload['private_note'], user_id, event_id)
         )
-        conn.commit()
-    conn.close()
+        if cur.rowcount:
+            bump_versions('event:' + event_id)
+            publish_entry_change(event_id, 'edit', [{
+                'uid': user_id,
+                'check_in': cin,
+                'check_out': cout,
+                'position': payload['role'],
+                'private_note': payload['private_note']
+            }])
     return {
         'success': True,
         'edits': {
@@ -329,86 +552,200 @@ def edit_entry(event_id, user_id, payload):
         }
     }
 
-def remove_user(event_id, user_id):
-    conn = get_db_connection()
+def _remove_entries(event_id, user_ids, conn: psycopg.Connection = None):
+    if conn is None:
+        conn = get_db()
     with conn.cursor() as cur:
+        # Same lock as join_event, which updates event_occupancy before entries
+        cur.execute('SELECT id FROM public.events WHERE id = %s FOR UPDATE', (event_id, ))
         cur.execute(
-            'DELETE FROM public.entries WHERE eid = %s AND uid = %s',
-            (event_id, user_id)
+            """
+            WITH removed AS (
+                DELETE FROM public.entries WHERE eid = %(eid)s AND uid = ANY(%(uids)s) RETURNING uid
+            ), counted AS (
+                UPDATE public.event_occupancy SET
+                    filled = public.event_occupancy.filled - delta.filled,
+                    reserve_filled = public.event_occupancy.reserve_filled - delta.reserve_filled
+                FROM (
+                    SELECT count(*) AS filled, count(*) FILTER (WHERE period = ANY(%(reserved_periods)s)) AS reserve_filled
+                    FROM removed JOIN public.users ON uid = id
+                ) AS delta
+                WHERE public.event_occupancy.eid = %(eid)s
+            )
+            SELECT uid FROM removed
+            """,
+            {
+                'eid': event_id,
+                'uids': user_ids,
+                'reserved_periods': RESERVED_PERIODS
+            }
+        )
+        removed = [row['uid'] for row in cur.fetchall()]
+    if removed:
+        enqueue_calendar_change(event_id, 'attendees', {'remove': [_get_user_email(user_id) for user_id in removed]}, conn=conn)
+        bump_versions('event:' + event_id, conn=conn)
+        row = get_event_row(event_id, conn=conn)
+        publish_entry_change(event_id, 'remove', [{'uid': user_id} for user_id in removed], get_event_limits(row), conn=conn)
+    return removed
+
+def remove_users_everywhere(user_ids, conn: psycopg.Connection = None):
+    # For users about to be deleted. Their entries go through _remove_entries
+    # while the user rows still exist, so occupancy, Calendar and open
+    # dashboards are updated, and their check in codes are dropped.
+    if conn is None:
+        conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(
+            'SELECT eid, array_agg(uid ORDER BY uid) AS uids FROM public.entries WHERE uid = ANY(%s) GROUP BY eid ORDER BY eid',
+            (user_ids, )
         )
-        conn.commit()
-    conn.close()
-    _remove_email_from_gcal(event_id, user_id + '@fjuhsd.org')
+        events = cur.fetchall()
+        cur.execute('DELETE FROM public.qr WHERE uid = ANY(%s)', (user_ids, ))
+    removed = 0
+    for event in events:
+        removed += len(_remove_entries(event['eid'], event['uids'], conn=conn))
+    return removed
+
+def remove_user(event_id, user_id):
+    _remove_entries(event_id, [user_id])
     return {
         'success': True
     }
 
+def remove_users_from_event(event_id, user_ids):
+    if not _is_user_id_list(user_ids):
+        return _invalid_user_list()
+    user_ids = list(dict.fromkeys(user_ids))
+    removed = set(_remove_entries(event_id, user_ids))
+    results = []
+    for user_id in user_ids:
+        if user_id in removed:
+            results.append({
+                'id': user_id,
+                'success': True
+            })
+        else:
+            results.append({
+                'id': user_id,
+                'success': False,
+                'error': 'Failed to Remove from Event',
+                'friendly': 'User is not a member of the event.'
+            })
+    return {
+        'success': True,
+        'results': results
+    }
+
 def remove_event(event_id):
-    calendar_api = get_calendar_api()
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute(
-            'DELETE FROM public.entries WHERE eid = %s',
-            (event_id,)
-        )
-        cur.execute(
-            'DELETE FROM public.qr WHERE eid = %s',
-            (event_id,)
-        )
-        cur.execute(
-            'DELETE FROM public.events WHERE id = %s',
-            (event_id,)
-        )
-        conn.commit()
-    conn.close()
+    conn = get_db()
+    # Event row first like every other writer, then qr before entries like a
+    # scan and event_occupancy before entries like a join, so none of them can
+    # deadlock with this
+    with conn.pipeline():
+        conn.execute('SELECT id FROM public.events WHERE id = %s FOR UPDATE', (event_id, ))
+        conn.execute('DELETE FROM public.qr WHERE eid = %s', (event_id, ))
+        conn.execute('DELETE FROM public.event_occupancy WHERE eid = %s', (event_id, ))
+        conn.execute('DELETE FROM public.entries WHERE eid = %s', (event_id, ))
+        conn.execute('DELETE FROM public.events WHERE id = %s', (event_id, ))
+
+    bump_versions('event:' + event_id)
+    enqueue_calendar_change(event_id, 'delete')
+    publish('dashboard:' + event_id, {'type': 'event_removed'})
 
-    calendar_api.events().delete(calendarId=CALENDAR_ID, eventId=event_id, sendUpdates='all').execute()
-    
     return {
         'success': True
     }
 
 def _get_today() -> datetime.datetime:
-    return datetime.datetime.now().astimezone(PACIFIC_TIME).replace(hour=0, minute=0)
+    today = datetime.datetime.now(PACIFIC_TIME).date()
+    return PACIFIC_TIME.localize(datetime.datetime.combine(today, datetime.time()))
 
 def _get_tomorrow() -> datetime.datetime:
-    return _get_today() + datetime.timedelta(days=1)
-
-def _get_upcoming_events():
-    tomorrow = _get_tomorrow()
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute(
-            'SELECT * FROM public.events WHERE start > %s ORDER BY start ASC',
-            (tomorrow, )
-        )
-        events = cur.fetchall()
-    conn.close()
-    return events
-
-def _get_previous_events():
-    today = _get_today()
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute(
-            'SELECT * FROM public.events WHERE start < %s ORDER BY start DESC',
-            (today, )
-        )
-        events = cur.fetchall()
-    conn.close()
-    return events
+    # Localized on its own rather than adding a day to today, so the offset is
+    # right across daylight saving changes
+    tomorrow = _get_today().date() + datetime.timedelta(days=1)
+    return PACIFIC_TIME.localize(datetime.datetime.combine(tomorrow, datetime.time()))
+
+def seconds_until_tomorrow() -> float:
+    return (_get_tomorrow() - datetime.datetime.now(pytz.utc)).total_seconds()
+
+def _encode_cursor(start: datetime.datetime, key: str) -> str:
+    raw = json.dumps([start.isoformat(), key]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    # No cursor means start from the most recent event
+    if not cursor:
+        return datetime.datetime.max.replace(tzinfo=pytz.utc), ''
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        start, key = json.loads(raw)
+        start = datetime.datetime.fromisoformat(start)
+    except (ValueError, TypeError):
+        raise ValueError('Malformed cursor')
+    if start.tzinfo is None or not isinstance(key, str):
+        raise ValueError('Malformed cursor')
+    return start, key
+
+def _normalize_page_size(page_size) -> int:
+    try:
+        page_size = int(page_size)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return min(max(page_size, 1), MAX_PAGE_SIZE)
+
+def _paginate(rows, page_size, key):
+    # Queries fetch one row past the page to learn whether another page follows
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, _encode_cursor(rows[-1]['start'], rows[-1][key])
+    return rows, None
+
+def _invalid_cursor():
+    return {
+        'success': False,
+        'error': 'Invalid Cursor',
+        'friendly': 'The requested page of previous events could not be found, try refreshing the page.'
+    }
 
-def _get_today_events():
+def _get_bucketed_events(before, page_size, user_id=None):
     today = _get_today()
     tomorrow = _get_tomorrow()
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
-            'SELECT * FROM public.events WHERE start > %s AND start < %s ORDER BY start ASC',
-            (today, tomorrow)
+            """
+            (
+                SELECT
+                    public.events.*,
+                    CASE WHEN start < %(tomorrow)s THEN 'today' ELSE 'upcoming' END AS bucket,
+                    coalesce(filled, 0) AS filled,
+                    coalesce(reserve_filled, 0) AS reserve_filled,
+                    EXISTS (SELECT 1 FROM public.entries WHERE eid = public.events.id AND uid = %(uid)s) AS joined
+                FROM public.events
+                LEFT JOIN public.event_occupancy ON eid = id
+                WHERE start >= %(today)s
+            )
+            UNION ALL
+            (
+                SELECT public.events.*, 'previous', 0, 0, false
+                FROM public.events
+                WHERE start < %(today)s AND (start, id) < (%(before_start)s, %(before_id)s)
+                ORDER BY start DESC, id DESC
+                LIMIT %(page_size)s
+            )
+            ORDER BY start ASC, id ASC
+            """,
+            {
+                'today': today,
+                'tomorrow': tomorrow,
+                'uid': user_id,
+                'before_start': before[0],
+                'before_id': before[1],
+                'page_size': page_size + 1
+            }
         )
         events = cur.fetchall()
-    conn.close()
     return events
 
 def _get_id_event_data(row):
@@ -425,100 +762,71 @@ def _get_user_event_data(row):
     data['start'] = row['start']
     return data
 
-def upcoming(user=None):
-    rows = _get_upcoming_events()
-    ret = []
-    ids = []
-    for row in rows:
-        ret.append(_get_id_event_data(row))
-        ids.append(ret[-1]['id'])
-    if user:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute('SELECT uid, period, eid FROM public.entries JOIN public.users ON uid = id WHERE eid = ANY(%s)', (ids, ))
-            entries = cur.fetchall()
-        conn.close()
-        for i in range(len(ret)):
-            eid = ret[i]['id']
-            event_entries = [e for e in entries if e['eid'] == eid]
-            event_limits = get_event_limits(ret[i], event_entries)
-            user_event_limts = get_user_event_limits(event_limits, event_entries, user)
-            ret[i]['eventLimits'] = event_limits
-            ret[i]['userEventLimits'] = user_event_limts
-    return ret
-
-def previous():
-    rows = _get_previous_events()
-    ret = []
-    for row in rows:
-        ret.append(_get_id_event_data(row))
-    return ret
-
-def today(user=None):
-    rows = _get_today_events()
-    ret = []
-    ids = []
+def list_events(user=None, cursor=None, page_size=None):
+    try:
+        before = _decode_cursor(cursor)
+    except ValueError:
+        return _invalid_cursor()
+    page_size = _normalize_page_size(page_size)
+    buckets = {
+        'upcoming': [],
+        'today': []
+    }
+    previous_rows = []
+    rows = _get_bucketed_events(before, page_size, user['id'] if user else None)
     for row in rows:
-        ret.append(_get_id_event_data(row))
-        ids.append(ret[-1]['id'])
-    if user:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute('SELECT uid, period, eid FROM public.entries JOIN public.users ON uid = id WHERE eid = ANY(%s)', (ids, ))
-            entries = cur.fetchall()
-        conn.close()
-        for i in range(len(ret)):
-            eid = ret[i]['id']
-            event_entries = [e for e in entries if e['eid'] == eid]
-            event_limits = get_event_limits(ret[i], event_entries)
-            user_event_limts = get_user_event_limits(event_limits, event_entries, user)
-            ret[i]['eventLimits'] = event_limits
-            ret[i]['userEventLimits'] = user_event_limts
-    return ret
-
-def list_events(user=None):
+        if row['bucket'] == 'previous':
+            previous_rows.append(row)
+            continue
+        data = _get_id_event_data(row)
+        if user:
+            event_limits = _event_limits_from_counts(data, row['filled'], row['reserve_filled'])
+            data['eventLimits'] = event_limits
+            data['userEventLimits'] = _user_event_limits_from_counts(event_limits, row['filled'], row['joined'], user)
+        buckets[row['bucket']].append(data)
+    # Rows arrive oldest first, previous events are listed most recent first
+    previous_rows.reverse()
+    previous_rows, next_cursor = _paginate(previous_rows, page_size, 'id')
     return {
         'success': True,
-        'upcoming': upcoming(user=user),
-        'previous': previous(),
-        'today': today(user=user)
+        'upcoming': buckets['upcoming'],
+        'previous': [_get_id_event_data(row) for row in previous_rows],
+        'today': buckets['today'],
+        'nextCursor': next_cursor
     }
 
 def _get_upcoming_user_events(user_id):
     tomorrow = _get_tomorrow()
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
             'SELECT eid, title, start, "end", position, check_in, check_out, "limit", "reserved" FROM public.entries JOIN public.events ON eid = id WHERE uid = %s AND start > %s ORDER BY start ASC',
             (user_id, tomorrow)
         )
         events = cur.fetchall()
-    conn.close()
     return events
 
-def _get_previous_user_events(user_id):
+def _get_previous_user_events(user_id, before, page_size):
     today = _get_today()
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
-            'SELECT eid, title, start, "end", position, check_in, check_out, "limit", "reserved" FROM public.entries JOIN public.events ON eid = id WHERE uid = %s AND start < %s ORDER BY start DESC',
-            (user_id, today)
+            'SELECT eid, title, start, "end", position, check_in, check_out, "limit", "reserved" FROM public.entries JOIN public.events ON eid = id WHERE uid = %s AND start < %s AND (start, eid) < (%s, %s) ORDER BY start DESC, eid DESC LIMIT %s',
+            (user_id, today, before[0], before[1], page_size + 1)
         )
         events = cur.fetchall()
-    conn.close()
     return events
 
 def _get_today_user_events(user_id):
     tomorrow = _get_tomorrow()
     today = _get_today()
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
             'SELECT eid, title, start, "end", position, check_in, check_out, "limit", "reserved" FROM public.entries JOIN public.events ON eid = id WHERE uid = %s AND start > %s AND start < %s ORDER BY start ASC',
             (user_id, today, tomorrow)
         )
         events = cur.fetchall()
-    conn.close()
     return events
 
 def user_upcoming(user_id):
@@ -529,13 +837,14 @@ def user_upcoming(user_id):
         ret.append(data)
     return ret
 
-def user_previous(user_id):
-    rows = _get_previous_user_events(user_id)
+def user_previous(user_id, before, page_size):
+    rows = _get_previous_user_events(user_id, before, page_size)
+    rows, next_cursor = _paginate(rows, page_size, 'eid')
     ret = []
     for row in rows:
         data = _get_user_event_data(row)
         ret.append(data)
-    return ret
+    return ret, next_cursor
 
 def user_today(user_id):
     rows = _get_today_user_events(user_id)
@@ -545,23 +854,28 @@ def user_today(user_id):
         ret.append(data)
     return ret
 
-def list_user_events(user_id):
+def list_user_events(user_id, cursor=None, page_size=None):
+    try:
+        before = _decode_cursor(cursor)
+    except ValueError:
+        return _invalid_cursor()
+    previous, next_cursor = user_previous(user_id, before, _normalize_page_size(page_size))
     return {
         'success': True,
         'upcoming': user_upcoming(user_id),
-        'previous': user_previous(user_id),
-        'today': user_today(user_id)
+        'previous': previous,
+        'today': user_today(user_id),
+        'nextCursor': next_cursor
     }
 
 def get_single_user_event_data(event_id, user_id):
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
         cur.execute(
             'SELECT eid, title, start, "end", position, check_in, check_out FROM public.entries JOIN public.events ON eid = id WHERE uid = %s AND eid = %s',
             (user_id, event_id)
         )
         row = cur.fetchone()
-    conn.close()
 
     return {
         'success': True,
@@ -588,3 +902,67 @@ def _get_event_for_edit(event_id):
         'limit': limit,
         'reserved': reserved
     }
+
+_ACTUAL_OCCUPANCY = """
+    SELECT
+        public.events.id AS eid,
+        count(public.users.id) AS filled,
+        count(public.users.id) FILTER (WHERE period = ANY(%(reserved_periods)s)) AS reserve_filled
+    FROM public.events
+    LEFT JOIN public.entries ON eid = public.events.id
+    LEFT JOIN public.users ON uid = public.users.id
+    GROUP BY public.events.id
+"""
+
+def rebuild_occupancy():
+    conn = get_db()
+    with conn.cursor() as cur:
+        # Hold off joins and removals while the counters are recomputed
+        cur.execute('LOCK TABLE public.entries, public.event_occupancy IN SHARE MODE')
+        cur.execute('DELETE FROM public.event_occupancy')
+        cur.execute(
+            'INSERT INTO public.event_occupancy (eid, filled, reserve_filled) ' + _ACTUAL_OCCUPANCY,
+            {'reserved_periods': RESERVED_PERIODS}
+        )
+        count = cur.rowcount
+    bump_all_events()
+    return count
+
+def recount_occupancy(event_ids, conn: psycopg.Connection = None):
+    # For users moved between periods, which the join and removal counters do
+    # not follow. The events are locked first like a join locks them.
+    if conn is None:
+        conn = get_db()
+    event_ids = sorted(set(event_ids))
+    if not event_ids:
+        return
+    with conn.cursor() as cur:
+        cur.execute('SELECT id FROM public.events WHERE id = ANY(%s) ORDER BY id FOR UPDATE', (event_ids, ))
+        cur.execute(
+            'INSERT INTO public.event_occupancy (eid, filled, reserve_filled) SELECT * FROM (' + _ACTUAL_OCCUPANCY + """) AS actual
+            WHERE eid = ANY(%(eids)s)
+            ON CONFLICT (eid) DO UPDATE SET filled = EXCLUDED.filled, reserve_filled = EXCLUDED.reserve_filled
+            """,
+            {'reserved_periods': RESERVED_PERIODS, 'eids': event_ids}
+        )
+    bump_versions(*['event:' + event_id for event_id in event_ids], conn=conn)
+
+def verify_occupancy():
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT
+                actual.eid,
+                stored.filled AS stored_filled,
+                stored.reserve_filled AS stored_reserve_filled,
+                actual.filled,
+                actual.reserve_filled
+            FROM (""" + _ACTUAL_OCCUPANCY + """) AS actual
+            LEFT JOIN public.event_occupancy AS stored ON stored.eid = actual.eid
+            WHERE stored.eid IS NULL OR stored.filled <> actual.filled OR stored.reserve_filled <> actual.reserve_filled
+            """,
+            {'reserved_periods': RESERVED_PERIODS}
+        )
+        mismatches = cur.fetchall()
+    return mismatches
\ No newline at end of file
@@ -1,28 +1,76 @@
 import os
+import tempfile
+import threading
 
+import httplib2
+import requests
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
+TOKEN_PATH = os.path.join('.secrets', 'token.json')
 
-def _get_gapi_credential() -> Credentials:
-    creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists(os.path.join('.secrets', 'token.json')):
-        creds = Credentials.from_authorized_user_file(os.path.join('.secrets', 'token.json'), SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            raise Exception
-        # Save the credentials for the next run
-        with open(os.path.join('.secrets', 'token.json'), 'w') as token:
+_credentials = None
+_persisted_token = None
+_credentials_lock = threading.Lock()
+_refresh_session = requests.Session()
+
+_discovery_doc = None
+_discovery_lock = threading.Lock()
+
+# httplib2.Http is not thread safe, so each thread keeps its own client and
+# connection while sharing the credentials and discovery document
+_local = threading.local()
+
+def _save_gapi_credential(creds: Credentials):
+    # Write to a temporary file and rename it so a crash or a concurrent reader
+    # never sees a half written token
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(TOKEN_PATH))
+    try:
+        with os.fdopen(fd, 'w') as token:
             token.write(creds.to_json())
-    return creds
+        os.replace(tmp_path, TOKEN_PATH)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def _get_gapi_credential() -> Credentials:
+    global _credentials, _persisted_token
+    with _credentials_lock:
+        if _credentials is None:
+            # The file token.json stores the user's access and refresh tokens, and is
+            # created by oauth_setup.py when the authorization flow completes.
+            if not os.path.exists(TOKEN_PATH):
+                raise Exception
+            _credentials = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+            _persisted_token = _credentials.token
+        if not _credentials.valid:
+            if _credentials.expired and _credentials.refresh_token:
+                _credentials.refresh(Request(session=_refresh_session))
+            else:
+                raise Exception
+        # Only write back when the access token actually changed, which also
+        # covers refreshes done by AuthorizedHttp after a rejected request
+        if _credentials.token != _persisted_token:
+            _save_gapi_credential(_credentials)
+            _persisted_token = _credentials.token
+        return _credentials
+
+def _get_discovery_doc() -> str:
+    global _discovery_doc
+    with _discovery_lock:
+        if _discovery_doc is None:
+            _discovery_doc = discovery_cache.get_static_doc('calendar', 'v3')
+        return _discovery_doc
 
 def get_calendar_api():
-    return build('calendar', 'v3', credentials=_get_gapi_credential())
\ No newline at end of file
+    creds = _get_gapi_credential()
+    calendar_api = getattr(_local, 'calendar_api', None)
+    if calendar_api is None:
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=30))
+        calendar_api = build_from_document(_get_discovery_doc(), http=http)
+        _local.calendar_api = calendar_api
+    return calendar_api
\ No newline at end of file
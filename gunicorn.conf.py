@@ -0,0 +1,32 @@
+import os
+
+# Run with "gunicorn" from this directory, it picks this file up by itself
+
+wsgi_app = 'wsgi:app'
+bind = os.getenv('BIND', '0.0.0.0:6512')
+
+# Imports the app once in the master, workers start already loaded and a
+# restart does not wait for every worker to import it again
+preload_app = True
+
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# Every request holds one of a worker's threads, and so does every open
+# server-sent event stream, for up to an hour (dashboards) or 150 seconds (QR
+# codes). Streams past MAX_OPEN_STREAMS per worker, half the threads unless
+# set, are refused so the rest stay free for scans. For a check in rush serve
+# with "hypercorn asgi:app" instead, where QR streams hold no thread.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+def post_worker_init(worker):
+    # Runs in the forked worker, so the pool belongs to it. Opening it here
+    # fills connections before the first request instead of during it
+    from db import get_pool
+    from notify import limit_open_streams
+    get_pool()
+    # Read here and not above, .env is only loaded once the app is imported
+    limit_open_streams(int(os.getenv('MAX_OPEN_STREAMS', threads // 2)))
\ No newline at end of file
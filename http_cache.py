@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+from functools import wraps
+
+from cachetools import TLRUCache
+from flask import g, request, current_app, make_response
+
+from events import PACIFIC_TIME, seconds_until_tomorrow
+from notify import RESYNC, add_callback
+from versions import get_versions
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '300'))
+RESPONSE_CACHE_PREFIX = 'crew:response:'
+RESPONSE_CACHE_TAG_PREFIX = 'crew:tag:'
+
+# Entries are {'body', 'etag', 'tags', 'expires'}. The lock also orders stores
+# against invalidations so a store can never land after the delete meant for it.
+_response_cache = TLRUCache(maxsize=RESPONSE_CACHE_SIZE, ttu=lambda key, entry, now: entry['expires'], timer=time.time)
+_response_cache_lock = threading.Lock()
+_generations = {}
+_epoch = 0
+_redis = None
+_listening = False
+
+def _vary_parts(per_user, per_day):
+    parts = [request.path, request.query_string.decode()]
+    if per_user:
+        user = g.get('user')
+        parts.append(f"{user['id']}:{user['period']}" if user else 'anonymous')
+    if per_day:
+        # Today's and upcoming events are bucketed by the Pacific date
+        parts.append(datetime.datetime.now(PACIFIC_TIME).date().isoformat())
+    return parts
+
+# Answers If-None-Match with 304 when none of the view's resources changed.
+# Resource names are formatted with the view's arguments, e.g. 'event:{event_id}'.
+# Goes below the authorization decorators since it may read g.user.
+def conditional_get(*resources, per_user=False, per_day=False):
+    def decorator(f):
+        @wraps(f)
+        def wrap(*args, **kwargs):
+            names = [resource.format(**kwargs) for resource in resources]
+            # Versions are read before the data, so a write committing in
+            # between can only make the body newer than its ETag
+            versions = get_versions(names)
+            parts = [f'{name}={versions[name]}' for name in names] + _vary_parts(per_user, per_day)
+            etag = hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrap
+    return decorator
+
+def _get_redis():
+    global _redis
+    url = os.getenv('RESPONSE_CACHE_REDIS_URL')
+    if not url:
+        return None
+    if _redis is None:
+        # Optional dependency, only needed when the cache is shared through Redis
+        import redis
+        _redis = redis.Redis.from_url(url)
+    return _redis
+
+def _cache_get(key):
+    redis_client = _get_redis()
+    if redis_client is None:
+        with _response_cache_lock:
+            return _response_cache.get(key)
+    value = redis_client.get(key)
+    if value is None:
+        return None
+    return json.loads(value)
+
+def _cache_set(key, entry):
+    # Called with _response_cache_lock held
+    redis_client = _get_redis()
+    if redis_client is None:
+        _response_cache[key] = entry
+        return
+    ttl = max(int(entry['expires'] - time.time()), 1)
+    with redis_client.pipeline() as pipe:
+        pipe.set(key, json.dumps(entry), ex=ttl)
+        for tag in entry['tags']:
+            pipe.sadd(RESPONSE_CACHE_TAG_PREFIX + tag, key)
+            pipe.expire(RESPONSE_CACHE_TAG_PREFIX + tag, int(RESPONSE_CACHE_TTL) + 1)
+        pipe.execute()
+
+def _invalidate(tags):
+    with _response_cache_lock:
+        for tag in tags:
+            _generations[tag] = _generations.get(tag, 0) + 1
+        redis_client = _get_redis()
+        if redis_client is None:
+            for key, entry in list(_response_cache.items()):
+                if tags.intersection(entry['tags']):
+                    _response_cache.pop(key, None)
+            return
+        tag_keys = [RESPONSE_CACHE_TAG_PREFIX + tag for tag in tags]
+        keys = redis_client.sunion(tag_keys)
+        redis_client.delete(*keys, *tag_keys)
+
+def _clear():
+    global _epoch
+    with _response_cache_lock:
+        _epoch += 1
+        redis_client = _get_redis()
+        if redis_client is None:
+            _response_cache.clear()
+            return
+        for prefix in (RESPONSE_CACHE_PREFIX, RESPONSE_CACHE_TAG_PREFIX):
+            for key in redis_client.scan_iter(prefix + '*'):
+                redis_client.delete(key)
+
+def _on_versions(message):
+    # Notifications can be missed while the listener is reconnecting
+    if message is RESYNC:
+        _clear()
+        return
+    tags = set()
+    for name in message['names']:
+        if name == 'event:*':
+            _clear()
+            return
+        if name.startswith('event:'):
+            tags.update((name, 'events'))
+    if tags:
+        _invalidate(tags)
+
+def _listen_for_versions():
+    global _listening
+    with _response_cache_lock:
+        if _listening:
+            return
+        _listening = True
+    add_callback('versions', _on_versions)
+
+def _generation(tags):
+    # Called with _response_cache_lock held
+    return (_epoch, [_generations.get(tag, 0) for tag in tags])
+
+def _cached_response(entry):
+    if request.if_none_match.contains(entry['etag']):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+# Shares responses between anonymous visitors until one of the tags is
+# invalidated by a version bump or Pacific midnight, whichever comes first.
+# Tags are formatted like conditional_get resources and 'event:<id>' also
+# invalidates 'events'. Goes under inject_user and above conditional_get.
+def cache_anonymous(*tags):
+    def decorator(f):
+        @wraps(f)
+        def wrap(*args, **kwargs):
+            if g.get('user'):
+                return f(*args, **kwargs)
+            _listen_for_versions()
+            names = [tag.format(**kwargs) for tag in tags]
+            key = RESPONSE_CACHE_PREFIX + datetime.datetime.now(PACIFIC_TIME).date().isoformat() + ':' + request.full_path
+            entry = _cache_get(key)
+            if entry is not None:
+                return _cached_response(entry)
+
+            with _response_cache_lock:
+                generation = _generation(names)
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.get_etag()[0] is None:
+                return response
+            entry = {
+                'body': response.get_data(as_text=True),
+                'etag': response.get_etag()[0],
+                'tags': names,
+                'expires': time.time() + min(RESPONSE_CACHE_TTL, seconds_until_tomorrow())
+            }
+            with _response_cache_lock:
+                # Skip the store if a write was announced while the view ran,
+                # the body may predate it
+                if _generation(names) == generation:
+                    _cache_set(key, entry)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrap
+    return decorator
@@ -0,0 +1,33 @@
+import decimal
+
+import orjson
+from flask.json.provider import JSONProvider
+
+# Datetimes come out as ISO 8601. Database sessions run in UTC (see db.py) and
+# the handlers build UTC times, so they end in Z, and naive ones are taken as UTC.
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def dumps(obj) -> str:
+    # For code that runs without an app, like the notify payloads
+    return orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS).decode()
+
+class OrjsonProvider(JSONProvider):
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson already produces bytes, skip the round trip through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS), mimetype=self.mimetype)
\ No newline at end of file
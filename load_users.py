@@ -1,20 +1,101 @@
 import os
-import psycopg
 import csv
+import argparse
+
+import psycopg
+from psycopg.rows import dict_row
+
+from events import recount_occupancy, remove_users_everywhere
+from versions import bump_versions
+
+def _read_roster(path):
+    with open(path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            nickname = None
+            if row['nickname']:
+                nickname = row['nickname']
+            yield (row['u_id'], row['last_name'], row['first_name'], nickname, row['grade'], row['period'], row['class'])
+
+def load_users(cursor: psycopg.Cursor, path, prune=False):
+    # Rows are streamed straight from the file into an unindexed staging table
+    # so memory use does not depend on the size of the roster
+    cursor.execute('CREATE TEMPORARY TABLE users_staging (LIKE public.users) ON COMMIT DROP')
+    with cursor.copy('COPY users_staging (id, last_name, first_name, nickname, grade, period, class) FROM STDIN') as copy:
+        for row in _read_roster(path):
+            copy.write_row(row)
+    cursor.execute('ANALYZE users_staging')
 
-def add_user(cursor: psycopg.Cursor, uid, last_name, first_name, nickname, grade, period, classs):
     cursor.execute(
-            "INSERT INTO public.users (id, last_name, first_name, nickname, grade, period, class) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-            (uid, last_name, first_name, nickname, grade, period, classs)
+        """
+        WITH incoming AS (
+            SELECT DISTINCT ON (id) * FROM users_staging ORDER BY id
+        ), moved AS (
+            SELECT coalesce(array_agg(id), '{}') AS moved FROM public.users JOIN incoming USING (id)
+            WHERE public.users.period IS DISTINCT FROM incoming.period
+        ), merged AS (
+            INSERT INTO public.users AS existing (id, last_name, first_name, nickname, grade, period, class)
+            SELECT id, last_name, first_name, nickname, grade, period, class FROM incoming
+            ON CONFLICT (id) DO UPDATE SET
+                last_name = EXCLUDED.last_name,
+                first_name = EXCLUDED.first_name,
+                nickname = EXCLUDED.nickname,
+                grade = EXCLUDED.grade,
+                period = EXCLUDED.period,
+                class = EXCLUDED.class
+            WHERE (existing.last_name, existing.first_name, existing.nickname, existing.grade, existing.period, existing.class)
+                IS DISTINCT FROM (EXCLUDED.last_name, EXCLUDED.first_name, EXCLUDED.nickname, EXCLUDED.grade, EXCLUDED.period, EXCLUDED.class)
+            RETURNING xmax = 0 AS inserted
         )
+        SELECT
+            count(*) FILTER (WHERE inserted) AS added,
+            count(*) FILTER (WHERE NOT inserted) AS changed,
+            (SELECT moved FROM moved) AS moved
+        FROM merged
+        """
+    )
+    report = cursor.fetchone()
 
-with open('users.csv', newline='') as csvfile:
-    reader = csv.DictReader(csvfile)
-    with psycopg.connect(os.environ["DATABASE_URL"]) as conn:
+    # Reserved seats are counted by period, so the events these students
+    # joined are recounted in the same transaction as their move
+    cursor.execute('SELECT DISTINCT eid FROM public.entries WHERE uid = ANY(%s)', (report['moved'], ))
+    recount_occupancy([row['eid'] for row in cursor.fetchall()], conn=cursor.connection)
+
+    # Staff accounts (grade 0) are not part of the student roster export
+    cursor.execute(
+        'SELECT id FROM public.users WHERE grade <> 0 AND NOT EXISTS (SELECT 1 FROM users_staging WHERE users_staging.id = public.users.id)'
+    )
+    missing = [row['id'] for row in cursor.fetchall()]
+    if prune:
+        # Entries are removed first, through the same path as an admin removing
+        # them, so occupancy counters and Calendar attendees stay in sync
+        entries = remove_users_everywhere(missing, conn=cursor.connection)
+        cursor.execute('DELETE FROM public.users WHERE id = ANY(%s)', (missing, ))
+    else:
+        cursor.execute('SELECT count(*) AS entries FROM public.entries WHERE uid = ANY(%s)', (missing, ))
+        entries = cursor.fetchone()['entries']
+    bump_versions('users', conn=cursor.connection)
+    return {
+        'added': report['added'],
+        'changed': report['changed'],
+        'moved': len(report['moved']),
+        'removed': len(missing),
+        'entries': entries
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the student roster into public.users')
+    parser.add_argument('path', nargs='?', default='users.csv')
+    parser.add_argument('--prune', action='store_true', help='delete students that are no longer in the roster')
+    args = parser.parse_args()
+
+    with psycopg.connect(os.environ["DATABASE_URL"], row_factory=dict_row) as conn:
         with conn.cursor() as cur:
-            for row in reader:
-                nickname = None
-                if row['nickname']:
-                    nickname = row['nickname']
-                add_user(cur, row['u_id'], row['last_name'], row['first_name'], nickname, row['grade'], row['period'], row['class'])
-            conn.commit()
\ No newline at end of file
+            report = load_users(cur, args.path, prune=args.prune)
+        conn.commit()
+
+    print(f"Added {report['added']} students, updated {report['changed']}")
+    if args.prune:
+        print(f"Removed {report['removed']} students no longer in {args.path} and their {report['entries']} event entries")
+    else:
+        print(f"{report['removed']} students with {report['entries']} event entries are no longer in {args.path}, rerun with --prune to remove them")
\ No newline at end of file
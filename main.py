@@ -1,3 +1,5 @@
+import threading
+
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -5,7 +7,11 @@ load_dotenv()
 from flask import Flask, request, g
 from flask_cors import CORS
 
-from auth import gauth_login, authorization_required, admin_only, inject_user
+from auth import gauth_login, authorization_required, admin_only, inject_user, get_auth_cache_stats
+from db import get_pool_stats, ping_db, close_db
+from http_cache import conditional_get, cache_anonymous
+from json_provider import OrjsonProvider
+from calendar_sync import get_calendar_sync_status, run_calendar_worker
 from events import (
     new_event, 
     get_event_row, 
@@ -13,14 +19,16 @@ from events import (
     get_event_limits, 
     join_event, 
     get_user_event_limits, 
-    get_limit_entries,
     get_event_dashboard,
+    stream_event_dashboard,
     instant_check_in,
     instant_check_out,
     edit_entry, list_events,
     list_user_events,
     get_single_user_event_data,
     remove_user,
+    add_users_to_event,
+    remove_users_from_event,
     _get_event_for_edit,
     edit_event,
     remove_event
@@ -29,7 +37,9 @@ from events import (
 from qr import (
     create_qr,
     get_data_from_qrid,
-    is_qrid_scanned
+    scan_qr,
+    is_qrid_scanned,
+    stream_qrid_scan_state
 )
 
 from users import (
@@ -37,7 +47,32 @@ from users import (
 )
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, origins='*', send_wildcard=False)
+app.teardown_appcontext(close_db)
+
+@app.get('/healthz')
+def healthz():
+    # Liveness, answers as long as the worker can serve requests
+    return {
+        'success': True
+    }
+
+@app.get('/readyz')
+def readyz():
+    # Readiness, load balancers should only route here once this passes
+    try:
+        ping_db()
+    except Exception as e:
+        print(e)
+        return {
+            'success': False,
+            'error': 'Not Ready',
+            'friendly': 'The server cannot reach the database yet, try again in a moment.'
+        }, 503
+    return {
+        'success': True
+    }
 
 @app.post('/auth/google')
 def google_login():
@@ -60,18 +95,19 @@ def create_event():
 
 @app.get('/event/<event_id>')
 @inject_user
+@cache_anonymous('event:{event_id}')
+@conditional_get('event:{event_id}', per_user=True)
 def get_event(event_id):
-    row = get_event_row(event_id)
+    row = get_event_row(event_id, g.user['id'] if g.user else None)
     if row:
         data = get_event_data(row)
-        entries = get_limit_entries(event_id)
-        event_limits = get_event_limits(row, entries)
+        event_limits = get_event_limits(row)
         if g.user:
             return {
                 'success': True,
                 'eventData': data,
                 'eventLimits': event_limits,
-                'userEventLimits': get_user_event_limits(event_limits, entries, g.user)
+                'userEventLimits': get_user_event_limits(event_limits, row, g.user)
             }
         else: 
             return {
@@ -98,9 +134,16 @@ def user_join_event():
 @app.get('/event/<event_id>/dashboard')
 @authorization_required
 @admin_only
+@conditional_get('event:{event_id}', 'users')
 def populate_event_dashboard(event_id):
     return get_event_dashboard(event_id)
 
+@app.get('/event/<event_id>/dashboard/stream')
+@authorization_required
+@admin_only
+def stream_dashboard(event_id):
+    return stream_event_dashboard(event_id)
+
 @app.get('/event/<event_id>/user/<user_id>/checkin')
 @authorization_required
 @admin_only
@@ -128,19 +171,21 @@ def delete_user_from_event(event_id, user_id):
 
 @app.get('/events')
 @inject_user
+@cache_anonymous('events')
+@conditional_get('events', per_user=True, per_day=True)
 def get_event_lists():
-    return list_events(user=g.user)
+    return list_events(user=g.user, cursor=request.args.get('cursor'), page_size=request.args.get('pageSize'))
 
 @app.get('/events/user')
 @authorization_required
 def get_user_events():
-    return list_user_events(g.user['id'])
+    return list_user_events(g.user['id'], cursor=request.args.get('cursor'), page_size=request.args.get('pageSize'))
 
 @app.get('/events/user/<user_id>')
 @authorization_required
 @admin_only
 def get_users_events(user_id):
-    return list_user_events(user_id)
+    return list_user_events(user_id, cursor=request.args.get('cursor'), page_size=request.args.get('pageSize'))
 
 @app.get('/event/<event_id>/user')
 @authorization_required
@@ -158,6 +203,12 @@ def generate_checkin_qr(event_id):
 def scan_qr_data(qrid):
     return get_data_from_qrid(qrid)
 
+@app.get('/scan/qr/<qrid>/<action>')
+@authorization_required
+@admin_only
+def scan_qr_action(qrid, action):
+    return scan_qr(qrid, action)
+
 @app.get('/event/<event_id>/edit')
 @authorization_required
 @admin_only
@@ -180,8 +231,9 @@ def delete_event(event_id):
 @app.get('/users')
 @authorization_required
 @admin_only
+@conditional_get('users')
 def list_all_users():
-    return get_all_users()
+    return get_all_users(request.args)
 
 @app.get('/event/<event_id>/add/<user_id>')
 @authorization_required
@@ -190,10 +242,54 @@ def admin_add_user_to_event(event_id, user_id):
     user = {'id': user_id}
     return join_event(event_id, user, admin=True)
 
+@app.post('/event/<event_id>/add')
+@authorization_required
+@admin_only
+def admin_add_users_to_event(event_id):
+    payload = request.json
+    return add_users_to_event(event_id, payload['users'], override=payload.get('override', False))
+
+@app.post('/event/<event_id>/remove')
+@authorization_required
+@admin_only
+def admin_remove_users_from_event(event_id):
+    payload = request.json
+    return remove_users_from_event(event_id, payload['users'])
+
+@app.get('/stats/pool')
+@authorization_required
+@admin_only
+def pool_stats():
+    return {
+        'success': True,
+        'pool': get_pool_stats()
+    }
+
+@app.get('/stats/auth')
+@authorization_required
+@admin_only
+def auth_stats():
+    return {
+        'success': True,
+        'cache': get_auth_cache_stats()
+    }
+
+@app.get('/calendar/status')
+@authorization_required
+@admin_only
+def calendar_sync_status():
+    return get_calendar_sync_status()
+
 @app.get('/qr/<qrid>')
 @authorization_required
 def check_qrid_scan_state(qrid):
     return is_qrid_scanned(qrid, g.user['id'])
 
+@app.get('/qr/<qrid>/stream')
+@authorization_required
+def stream_qrid_scan(qrid):
+    return stream_qrid_scan_state(qrid, g.user['id'])
+
 if __name__ == '__main__':
+    threading.Thread(target=run_calendar_worker, daemon=True).start()
     app.run(host='0.0.0.0', port=6512)
@@ -0,0 +1,148 @@
+import os
+import sys
+import argparse
+import subprocess
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from main import app
+from events import rebuild_occupancy, verify_occupancy
+from calendar_sync import run_calendar_worker
+from qr import reap_expired_qr
+from migrate import migrate, get_migration_status, check_indexes
+
+COLD_START_BUDGET = float(os.getenv('COLD_START_BUDGET', '1.0'))
+
+# Only needed by the Calendar worker or a Google login, loading any of them
+# when a web worker starts is a regression
+LAZY_MODULES = ['gapi', 'googleapiclient', 'google.auth.jwt']
+
+def occupancy(args):
+    with app.app_context():
+        if args.action == 'rebuild':
+            count = rebuild_occupancy()
+            print(f'Rebuilt occupancy counters for {count} events')
+            return 0
+        mismatches = verify_occupancy()
+    for row in mismatches:
+        print(
+            f"{row['eid']}: stored {row['stored_filled']} filled / {row['stored_reserve_filled']} reserved, "
+            f"actual {row['filled']} filled / {row['reserve_filled']} reserved"
+        )
+    if mismatches:
+        print(f'{len(mismatches)} events out of sync, run "python manage.py occupancy rebuild"')
+        return 1
+    print('Occupancy counters match the entries table')
+    return 0
+
+def calendar_worker(args):
+    run_calendar_worker(poll_interval=args.poll_interval)
+
+def reap_qr(args):
+    removed = reap_expired_qr(grace_minutes=args.grace_minutes)
+    print(f'Removed {removed} expired check in/out codes')
+    return 0
+
+def run_migrations(args):
+    if args.status:
+        for version, name, applied in get_migration_status():
+            print(f"{version} {name}: {'applied' if applied else 'pending'}")
+        return 0
+    applied = migrate()
+    for version, name in applied:
+        print(f'Applied {version} {name}')
+    if not applied:
+        print('Database schema is up to date')
+    return 0
+
+def run_index_checks(args):
+    failed = 0
+    for name, expected, used, indexes in check_indexes():
+        if used:
+            print(f"ok   {name}: {', '.join(indexes)}")
+        else:
+            failed += 1
+            print(f"FAIL {name}: expected {' or '.join(expected)}, plan uses {', '.join(indexes) or 'no index'}")
+    if failed:
+        print(f'{failed} queries do not use their index, run "python manage.py migrate"')
+        return 1
+    return 0
+
+def _import_times(module):
+    # A fresh interpreter, this one has already imported the app
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+def cold_start(args):
+    # Best of several runs, the first one also pays for reading the files
+    runs = [_import_times('wsgi') for _ in range(args.runs)]
+    times = min(runs, key=lambda run: run[-1][2])
+    total = times[-1][2] / 1e6
+    packages = {}
+    for name, self_us, cumulative_us in times:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    print(f'Importing the app takes {total:.2f}s, the budget is {args.budget:.2f}s')
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {package:<24} {self_us / 1e6:.3f}s')
+
+    failed = 0
+    loaded = {name for name, self_us, cumulative_us in times}
+    for module in LAZY_MODULES:
+        if module in loaded:
+            failed += 1
+            print(f'{module} is imported at startup, it should only load on first use')
+    if total > args.budget:
+        failed += 1
+        print(f'Over budget by {total - args.budget:.2f}s')
+    return 1 if failed else 0
+
+def run():
+    parser = argparse.ArgumentParser(description='crew-backend maintenance commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    occupancy_parser = commands.add_parser('occupancy', help='check or recompute the per-event occupancy counters')
+    occupancy_parser.add_argument('action', choices=['verify', 'rebuild'])
+    occupancy_parser.set_defaults(func=occupancy)
+
+    worker_parser = commands.add_parser('calendar-worker', help='push queued changes from the calendar outbox to Google Calendar')
+    worker_parser.add_argument('--poll-interval', type=float, default=None)
+    worker_parser.set_defaults(func=calendar_worker)
+
+    reap_parser = commands.add_parser('reap-qr', help='delete check in/out codes that expired more than the grace period ago')
+    reap_parser.add_argument('--grace-minutes', type=float, default=None)
+    reap_parser.set_defaults(func=reap_qr)
+
+    migrate_parser = commands.add_parser('migrate', help='apply pending schema migrations from migrations/')
+    migrate_parser.add_argument('--status', action='store_true', help='list migrations without applying them')
+    migrate_parser.set_defaults(func=run_migrations)
+
+    check_parser = commands.add_parser('check-indexes', help='EXPLAIN the hot queries and check they use their indexes')
+    check_parser.set_defaults(func=run_index_checks)
+
+    cold_start_parser = commands.add_parser('cold-start', help='measure how long a worker takes to import the app')
+    cold_start_parser.add_argument('--budget', type=float, default=COLD_START_BUDGET, help='seconds, exits with 1 when over')
+    cold_start_parser.add_argument('--runs', type=int, default=3)
+    cold_start_parser.add_argument('--top', type=int, default=10, help='slowest packages to list')
+    cold_start_parser.set_defaults(func=cold_start)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(run())
\ No newline at end of file
@@ -0,0 +1,137 @@
+import os
+import re
+import json
+
+import psycopg
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+# Arbitrary key shared by every process running migrations
+MIGRATION_LOCK_ID = 7305128
+
+# Queries on the hot paths and the indexes they may use. Checked with
+# sequential scans disabled so tiny development tables still show the plan
+# the index makes possible. On such tables the planner costs both entries
+# indexes the same, so either one counts for the eid lookups.
+INDEX_CHECKS = [
+    (
+        'user upcoming events',
+        'SELECT eid, title, start, "end", position, check_in, check_out FROM public.entries JOIN public.events ON eid = id WHERE uid = %s AND start > now() ORDER BY start ASC',
+        ('user', ),
+        ('entries_uid_idx', )
+    ),
+    (
+        'event membership',
+        'SELECT EXISTS (SELECT 1 FROM public.entries WHERE eid = %s AND uid = %s)',
+        ('event000', 'user'),
+        ('entries_pkey', 'entries_uid_idx')
+    ),
+    (
+        'event roster',
+        'SELECT * FROM public.entries WHERE eid = %s',
+        ('event000', ),
+        ('entries_pkey', 'entries_uid_idx')
+    ),
+    (
+        'upcoming events',
+        'SELECT id FROM public.events WHERE start >= now() ORDER BY start, id',
+        (),
+        ('events_start_idx', )
+    ),
+    (
+        'previous events page',
+        "SELECT id FROM public.events WHERE start < now() AND (start, id) < (now(), '') ORDER BY start DESC, id DESC LIMIT 20",
+        (),
+        ('events_start_idx', )
+    ),
+    (
+        'event check in codes',
+        'SELECT qrid FROM public.qr WHERE eid = %s AND uid = %s',
+        ('event000', 'user'),
+        ('qr_eid_uid_idx', )
+    ),
+    (
+        'expired check in codes',
+        "SELECT qrid FROM public.qr WHERE exp < now() - interval '1 hour'",
+        (),
+        ('qr_exp_idx', )
+    )
+]
+
+def _connect():
+    return psycopg.connect(os.environ["DATABASE_URL"])
+
+def _available_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((match.group(1), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+def _applied_versions(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS public.schema_migrations (
+            version character(4) NOT NULL PRIMARY KEY,
+            name character varying(255) NOT NULL,
+            applied timestamp with time zone NOT NULL DEFAULT now()
+        )
+        """
+    )
+    conn.commit()
+    return {row[0] for row in conn.execute('SELECT version FROM public.schema_migrations').fetchall()}
+
+def get_migration_status():
+    with _connect() as conn:
+        applied = _applied_versions(conn)
+    return [(version, name, version in applied) for version, name, path in _available_migrations()]
+
+def migrate():
+    applied_now = []
+    with _connect() as conn:
+        # Session level lock, held across the per-migration commits so two
+        # deploys starting together apply each migration once
+        conn.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID, ))
+        conn.commit()
+        try:
+            applied = _applied_versions(conn)
+            for version, name, path in _available_migrations():
+                if version in applied:
+                    continue
+                with open(path) as migration:
+                    statements = migration.read()
+                # Each migration commits on its own, a failure leaves the
+                # earlier ones applied and this one untouched
+                conn.execute(statements)
+                conn.execute('INSERT INTO public.schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+                conn.commit()
+                applied_now.append((version, name))
+        finally:
+            conn.rollback()
+            conn.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID, ))
+            conn.commit()
+    return applied_now
+
+def _plan_indexes(plan):
+    indexes = set()
+    if 'Index Name' in plan:
+        indexes.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        indexes.update(_plan_indexes(child))
+    return indexes
+
+def check_indexes():
+    results = []
+    with _connect() as conn:
+        for name, query, params, indexes in INDEX_CHECKS:
+            conn.execute('SET LOCAL enable_seqscan = off')
+            row = conn.execute('EXPLAIN (FORMAT JSON) ' + query, params).fetchone()
+            plan = row[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = _plan_indexes(plan[0]['Plan'])
+            results.append((name, indexes, bool(used.intersection(indexes)), sorted(used)))
+            conn.rollback()
+    return results
\ No newline at end of file
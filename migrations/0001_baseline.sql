@@ -0,0 +1,84 @@
+-- Tables as they existed before versioned migrations, so existing databases
+-- record this as applied without changes and new ones get the same starting point
+
+CREATE TABLE IF NOT EXISTS
+  public.users (
+    id character varying(32) NOT NULL,
+    last_name character varying(255) NOT NULL,
+    first_name character varying(255) NOT NULL,
+    nickname character varying(255) NULL,
+    grade smallint NOT NULL,
+    period smallint NOT NULL,
+    class character varying(32) NOT NULL,
+    CONSTRAINT users_pkey PRIMARY KEY (id)
+  );
+
+CREATE TABLE IF NOT EXISTS
+  public.events (
+    id character(8) NOT NULL,
+    title character varying(255) NOT NULL,
+    start timestamp with time zone NOT NULL,
+    "end" timestamp with time zone NOT NULL,
+    "limit" smallint NULL,
+    reserved smallint NULL,
+    CONSTRAINT events_pkey PRIMARY KEY (id)
+  );
+
+CREATE TABLE IF NOT EXISTS
+  public.entries (
+    uid character varying(32) NOT NULL,
+    eid character(8) NOT NULL,
+    check_in timestamp with time zone NULL,
+    check_out timestamp with time zone NULL,
+    "position" character varying(255) NULL,
+    user_note text NULL,
+    private_note text NULL
+  );
+
+CREATE TABLE IF NOT EXISTS
+  public.qr (
+    qrid character(16) NOT NULL,
+    eid character(8) NOT NULL,
+    uid character varying(32) NOT NULL,
+    exp timestamp with time zone NOT NULL,
+    scanned boolean NOT NULL DEFAULT false,
+    CONSTRAINT qr_pkey PRIMARY KEY (qrid)
+  );
+
+CREATE INDEX IF NOT EXISTS
+  qr_exp_idx ON public.qr (exp);
+
+CREATE TABLE IF NOT EXISTS
+  public.event_occupancy (
+    eid character(8) NOT NULL,
+    filled integer NOT NULL DEFAULT 0,
+    reserve_filled integer NOT NULL DEFAULT 0,
+    CONSTRAINT event_occupancy_pkey PRIMARY KEY (eid)
+  );
+
+CREATE TABLE IF NOT EXISTS
+  public.calendar_outbox (
+    id bigint GENERATED ALWAYS AS IDENTITY,
+    eid character(8) NOT NULL,
+    op character varying(16) NOT NULL,
+    payload jsonb NOT NULL DEFAULT '{}',
+    status character varying(16) NOT NULL DEFAULT 'pending',
+    attempts smallint NOT NULL DEFAULT 0,
+    next_attempt timestamp with time zone NOT NULL DEFAULT now(),
+    last_error text NULL,
+    created timestamp with time zone NOT NULL DEFAULT now(),
+    processed timestamp with time zone NULL,
+    CONSTRAINT calendar_outbox_pkey PRIMARY KEY (id)
+  );
+
+CREATE INDEX IF NOT EXISTS
+  calendar_outbox_pending_idx ON public.calendar_outbox (eid, id)
+WHERE
+  status = 'pending';
+
+CREATE TABLE IF NOT EXISTS
+  public.resource_versions (
+    name character varying(64) NOT NULL,
+    version bigint NOT NULL DEFAULT 0,
+    CONSTRAINT resource_versions_pkey PRIMARY KEY (name)
+  )
\ No newline at end of file
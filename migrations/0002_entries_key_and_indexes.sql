@@ -0,0 +1,35 @@
+-- An entry is one user in one event. The old key on eid alone could not hold
+-- more than one user per event, so databases may carry a different key or
+-- none, and racing joins may have left duplicates. Keep the most complete one.
+DELETE FROM public.entries
+WHERE ctid IN (
+  SELECT ctid FROM (
+    SELECT ctid, row_number() OVER (
+      PARTITION BY eid, uid
+      ORDER BY check_out IS NULL, check_in IS NULL, ctid
+    ) AS copy
+    FROM public.entries
+  ) AS copies
+  WHERE copy > 1
+);
+
+ALTER TABLE
+  public.entries
+DROP
+  CONSTRAINT IF EXISTS entries_pkey;
+
+ALTER TABLE
+  public.entries
+ADD
+  CONSTRAINT entries_pkey PRIMARY KEY (eid, uid);
+
+-- A user's events, covering the entry columns the listings select
+CREATE INDEX IF NOT EXISTS
+  entries_uid_idx ON public.entries (uid, eid) INCLUDE ("position", check_in, check_out);
+
+-- Day buckets and the keyset pagination on (start, id)
+CREATE INDEX IF NOT EXISTS
+  events_start_idx ON public.events (start, id);
+
+CREATE INDEX IF NOT EXISTS
+  qr_eid_uid_idx ON public.qr (eid, uid)
\ No newline at end of file
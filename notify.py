@@ -0,0 +1,184 @@
+import os
+import json
+import asyncio
+import time
+import queue
+import threading
+from functools import wraps
+
+import psycopg
+from flask import Response
+
+from db import get_db
+from json_provider import dumps
+
+CHANNEL = 'crew_updates'
+SSE_HEARTBEAT = 15
+
+NOTIFY_SQL = 'SELECT pg_notify(%s, %s)'
+
+# Postgres rejects payloads of this many bytes or more
+NOTIFY_MAX_BYTES = 8000
+
+# Put on every subscription once the listener is (re)connected. Notifications
+# sent before LISTEN ran are lost, so subscribers should read the state again
+RESYNC = object()
+
+TOO_MANY_STREAMS = {
+    'success': False,
+    'error': 'Too Many Streams',
+    'friendly': 'Live updates are busy right now, refresh the page to check again.'
+}
+
+_subscriptions = {}
+_callbacks = {}
+_subscriptions_lock = threading.Lock()
+_listener = None
+_stream_slots = None
+
+def publish(key, data, conn: psycopg.Connection = None):
+    # Sent on the writer's connection, Postgres only delivers it if the
+    # transaction commits
+    if conn is None:
+        conn = get_db()
+    conn.execute(NOTIFY_SQL, (CHANNEL, encode_notification(key, data)))
+
+def encode_notification(key, data):
+    payload = dumps({'key': key, 'data': data})
+    if len(payload.encode()) < NOTIFY_MAX_BYTES:
+        return payload
+    # Too large to send, and failing would roll back the write. Subscribers
+    # of the key get RESYNC instead and read the current state themselves.
+    return dumps({'key': key, 'resync': True})
+
+def _run_callback(callback, message):
+    try:
+        callback(message)
+    except Exception as e:
+        print(e)
+
+def _dispatch(key, message):
+    # Called with RESYNC as the message for a notification that was too large
+    with _subscriptions_lock:
+        subscribers = list(_subscriptions.get(key, ()))
+        callbacks = list(_callbacks.get(key, ()))
+    for subscription in subscribers:
+        subscription.put(message)
+    for callback in callbacks:
+        _run_callback(callback, message)
+
+def _resync_all():
+    with _subscriptions_lock:
+        subscribers = [subscription for subscribers in _subscriptions.values() for subscription in subscribers]
+        callbacks = [callback for callbacks in _callbacks.values() for callback in callbacks]
+    for subscription in subscribers:
+        subscription.put(RESYNC)
+    for callback in callbacks:
+        _run_callback(callback, RESYNC)
+
+def _listen():
+    while True:
+        try:
+            # Keepalives make a dead connection fail instead of blocking forever
+            with psycopg.connect(os.environ["DATABASE_URL"], autocommit=True, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3) as conn:
+                conn.execute('LISTEN ' + CHANNEL)
+                _resync_all()
+                for notification in conn.notifies():
+                    try:
+                        message = json.loads(notification.payload)
+                    except ValueError as e:
+                        print(e)
+                        continue
+                    _dispatch(message['key'], RESYNC if message.get('resync') else message['data'])
+        except Exception as e:
+            print(e)
+            time.sleep(1)
+
+def _start_listener():
+    global _listener
+    # Called with _subscriptions_lock held, one listener connection per process
+    if _listener is None or not _listener.is_alive():
+        _listener = threading.Thread(target=_listen, name='notify-listener', daemon=True)
+        _listener.start()
+
+class AsyncSubscription:
+    # For the async serving mode (asgi.py), which shares this process's
+    # listener. Filled from the listener thread and read on the event loop.
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+
+    def put(self, message):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+
+    async def get(self):
+        return await self._queue.get()
+
+def subscribe(key, subscription=None) -> queue.Queue:
+    # Subscribe before reading the current state so a change committed in
+    # between is still delivered
+    if subscription is None:
+        subscription = queue.Queue()
+    with _subscriptions_lock:
+        _start_listener()
+        _subscriptions.setdefault(key, set()).add(subscription)
+    return subscription
+
+def add_callback(key, callback):
+    # Runs on the listener thread for every notification on the key, and with
+    # RESYNC whenever the listener (re)connects
+    with _subscriptions_lock:
+        _start_listener()
+        _callbacks.setdefault(key, []).append(callback)
+
+def unsubscribe(key, subscription):
+    with _subscriptions_lock:
+        subscribers = _subscriptions.get(key)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del _subscriptions[key]
+
+def format_sse(data, event=None):
+    message = ''
+    if event:
+        message += 'event: ' + event + '\n'
+    return message + 'data: ' + data + '\n\n'
+
+def sse_response(stream):
+    # The stream runs after the request context is gone, so it must not use g
+    # or the request's database connection
+    return Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def limit_open_streams(count):
+    # Each open stream holds one of the server's threads until it ends. The
+    # servers call this with fewer slots than they have threads (see
+    # gunicorn.conf.py and asgi.py), the development server has no limit
+    global _stream_slots
+    _stream_slots = threading.BoundedSemaphore(count)
+
+def limit_streams(f):
+    # Refuses the stream once the slots are taken, the slot is given back when
+    # the server closes the response
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        slots = _stream_slots
+        if slots is None:
+            return f(*args, **kwargs)
+        if not slots.acquire(blocking=False):
+            return dict(TOO_MANY_STREAMS)
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            slots.release()
+            raise
+        if isinstance(result, Response):
+            result.call_on_close(slots.release)
+        else:
+            slots.release()
+        return result
+    return wrap
\ No newline at end of file
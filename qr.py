@@ -1,111 +1,293 @@
+import os
+import time
+import queue
 import secrets
 import datetime
 
-from db import get_db_connection
-from events import PACIFIC_TIME
+from flask import current_app
+from psycopg import sql
+
+from db import get_db, get_db_connection, insert_with_new_id, release_db_connection
+from events import PACIFIC_TIME, publish_entry_change
+from versions import bump_versions
+from notify import RESYNC, SSE_HEARTBEAT, publish, subscribe, unsubscribe, format_sse, sse_response, limit_streams
+
+QR_REAP_BATCH_SIZE = 5000
+
+# Scanner action to the entries column it stamps
+SCAN_ACTIONS = {
+    'checkin': 'check_in',
+    'checkout': 'check_out'
+}
+
+# The statements below are also run by the async routes in asgi.py, so the
+# two serving modes claim and stamp codes the same way
+
+QR_ENTRY_SQL = 'SELECT check_in, check_out FROM public.entries WHERE eid = %s AND uid = %s'
+
+# Retried with a new id while it collides, see db.insert_with_new_id
+ISSUE_QR_SQL = 'INSERT INTO public.qr (qrid, eid, uid, exp) VALUES (%s, %s, %s, %s) ON CONFLICT (qrid) DO NOTHING RETURNING qrid'
+
+# Only runs after a failed claim, to tell the scanner why
+UNCLAIMED_QR_SQL = """
+    SELECT exp < now() AS expired, scanned FROM public.qr
+    WHERE qrid = %s AND EXISTS (SELECT 1 FROM public.entries WHERE eid = public.qr.eid AND uid = public.qr.uid)
+"""
+
+# Claiming the code and checking it in one statement means two scanners can
+# never both accept it
+CLAIM_QR_SQL = """
+    WITH claimed AS (
+        UPDATE public.qr SET scanned = true
+        WHERE qrid = %s AND NOT scanned AND exp > now()
+            AND EXISTS (SELECT 1 FROM public.entries WHERE eid = public.qr.eid AND uid = public.qr.uid)
+        RETURNING *
+    )
+    SELECT * FROM claimed JOIN public.entries ON claimed.eid = public.entries.eid AND claimed.uid = public.entries.uid JOIN public.users ON claimed.uid = id JOIN public.events ON public.entries.eid = public.events.id
+"""
+
+SCAN_QR_SQL = sql.SQL(
+    """
+    WITH claimed AS (
+        UPDATE public.qr SET scanned = true
+        WHERE qrid = %s AND NOT scanned AND exp > now()
+            AND EXISTS (SELECT 1 FROM public.entries WHERE eid = public.qr.eid AND uid = public.qr.uid)
+        RETURNING eid, uid
+    ), stamped AS (
+        UPDATE public.entries SET {column} = now()
+        FROM claimed
+        WHERE public.entries.eid = claimed.eid AND public.entries.uid = claimed.uid
+        RETURNING public.entries.*
+    )
+    SELECT
+        stamped.eid, stamped.uid, stamped.check_in, stamped.check_out, stamped.position,
+        public.users.first_name, public.users.last_name, public.users.nickname, public.users.grade,
+        public.events.title
+    FROM stamped
+    JOIN public.users ON stamped.uid = public.users.id
+    JOIN public.events ON stamped.eid = public.events.id
+    """
+)
+
+QR_SCANNED_SQL = 'SELECT scanned FROM public.qr WHERE qrid = %s AND uid = %s'
+
+QR_SCAN_STATE_SQL = 'SELECT scanned, greatest(extract(epoch FROM exp - now()), 0) AS remaining FROM public.qr WHERE qrid = %s AND uid = %s'
+
+INVALID_QR = {
+    'success': False,
+    'error': 'Invalid QR',
+    'friendly': 'The check in/out code is invalid.'
+}
+
+INVALID_SCAN_ACTION = {
+    'success': False,
+    'error': 'Invalid Action',
+    'friendly': 'The scanner asked for an action that does not exist.'
+}
 
 def _generate_qrid():
     return secrets.token_hex(8)
 
-def create_qr(event_id, user_id):
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                'SELECT check_in, check_out FROM public.entries WHERE eid = %s AND uid = %s',
-                (event_id, user_id)
-            )
-            row = cur.fetchone()
-            if not row:
-                ret = {
-                    'success': False,
-                    'friendly': "You aren't listed as a participant of this event and thus cannot be issued a check in/out code.",
-                    'error': 'Unlisted User'
-                }
-                raise Exception
-            if row['check_in'] and row['check_out']:
-                ret = {
-                    'success': False,
-                    'error': 'User Event Complete',
-                    'friendly': "You've already been checked in and out of this event, a check in/out code is useless."
-                }
-                raise Exception
-            
-            qrid = None
-            while not qrid:
-                qrid = _generate_qrid()
-                cur.execute('SELECT * FROM public.qr WHERE qrid = %s', (qrid, ))
-                row = cur.fetchone()
-                if row:
-                    qrid = None
-            cur.execute(
-                'INSERT INTO public.qr (qrid, eid, uid, exp) VALUES (%s, %s, %s, %s)',
-                (qrid, event_id, user_id, datetime.datetime.now().astimezone(PACIFIC_TIME) + datetime.timedelta(seconds=150))
-            )
-            conn.commit()
-        conn.close()
+def qr_entry_error(row):
+    if not row:
         return {
-            'success': True,
-            'qrid': qrid
+            'success': False,
+            'friendly': "You aren't listed as a participant of this event and thus cannot be issued a check in/out code.",
+            'error': 'Unlisted User'
         }
-    except Exception:
-        conn.close()
-        return ret
+    if row['check_in'] and row['check_out']:
+        return {
+            'success': False,
+            'error': 'User Event Complete',
+            'friendly': "You've already been checked in and out of this event, a check in/out code is useless."
+        }
+    return None
 
-def get_data_from_qrid(qrid):
-    conn = get_db_connection()
+def qr_expiry() -> datetime.datetime:
+    return datetime.datetime.now().astimezone(PACIFIC_TIME) + datetime.timedelta(seconds=150)
+
+def create_qr(event_id, user_id):
+    conn = get_db()
     with conn.cursor() as cur:
-        cur.execute(
-            'SELECT * FROM public.qr JOIN public.entries ON public.qr.eid = public.entries.eid AND public.qr.uid = public.entries.uid JOIN public.users ON public.qr.uid = id JOIN public.events ON public.entries.eid = public.events.id WHERE qrid = %s',
-            (qrid, )
-        )
-        data = cur.fetchone()
-        if data:
-            cur.execute(
-                'UPDATE public.qr SET scanned = %s WHERE qrid = %s',
-                (True, qrid)
-            )
-            conn.commit()
-    conn.close()
-    if data:
-        if data['exp'].astimezone(PACIFIC_TIME) < datetime.datetime.now().astimezone(PACIFIC_TIME):
-            return {
-                'success': False,
-                'error': 'Expired QR Code',
-                'friendly': 'The check in/out code is invalid because it has expired.'
-            }
-        if data['scanned']:
-            return {
-                'success': False,
-                'error': 'Duplicate QR Code',
-                'friendly': 'The check in/out code is invalid because it has already been scanned.'
-            }
+        cur.execute(QR_ENTRY_SQL, (event_id, user_id))
+        error = qr_entry_error(cur.fetchone())
+        if error:
+            return error
+        
+        row = insert_with_new_id(cur, ISSUE_QR_SQL, _generate_qrid, (event_id, user_id, qr_expiry()))
+    return {
+        'success': True,
+        'qrid': row['qrid']
+    }
+
+def unclaimed_qr_error(row):
+    if row and row['expired']:
         return {
-            'success': True,
-            'data': data
+            'success': False,
+            'error': 'Expired QR Code',
+            'friendly': 'The check in/out code is invalid because it has expired.'
         }
-    else:
+    if row and row['scanned']:
         return {
             'success': False,
-            'error': 'Invalid QR',
-            'friendly': 'The check in/out code is invalid.'
+            'error': 'Duplicate QR Code',
+            'friendly': 'The check in/out code is invalid because it has already been scanned.'
         }
+    return dict(INVALID_QR)
+
+def get_data_from_qrid(qrid):
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(CLAIM_QR_SQL, (qrid, ))
+        data = cur.fetchone()
+        if not data:
+            cur.execute(UNCLAIMED_QR_SQL, (qrid, ))
+            return unclaimed_qr_error(cur.fetchone())
+    publish('qr:' + qrid, {'scanned': True})
+    return {
+        'success': True,
+        'data': data
+    }
+
+def scan_qr(qrid, action):
+    if action not in SCAN_ACTIONS:
+        return dict(INVALID_SCAN_ACTION)
+    change = SCAN_ACTIONS[action]
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(SCAN_QR_SQL.format(column=sql.Identifier(change)), (qrid, ))
+        data = cur.fetchone()
+        if not data:
+            cur.execute(UNCLAIMED_QR_SQL, (qrid, ))
+            return unclaimed_qr_error(cur.fetchone())
+    publish('qr:' + qrid, {'scanned': True})
+    bump_versions('event:' + data['eid'])
+    publish_entry_change(data['eid'], change, [{'uid': data['uid'], change: data[change]}])
+    return {
+        'success': True,
+        change: data[change],
+        'data': data
+    }
 
 def is_qrid_scanned(qrid, user_id):
-    conn = get_db_connection()
+    conn = get_db()
     with conn.cursor() as cur:
-        cur.execute(
-            'SELECT scanned FROM public.qr WHERE qrid = %s AND uid = %s',
-            (qrid, user_id)
-        )
+        cur.execute(QR_SCANNED_SQL, (qrid, user_id))
         data = cur.fetchone()
-    conn.close()
-    if data:
-        return {
-            'success': True,
-            'scanned': data['scanned']
-        }
     return {
         'success': True,
-        'scanned': False
-    }
\ No newline at end of file
+        'scanned': bool(data and data['scanned'])
+    }
+
+def _get_qr_scan_state(conn, qrid, user_id):
+    with conn.cursor() as cur:
+        cur.execute(QR_SCAN_STATE_SQL, (qrid, user_id))
+        return cur.fetchone()
+
+def _qr_scan_state_now(qrid, user_id):
+    conn = get_db_connection()
+    try:
+        return _get_qr_scan_state(conn, qrid, user_id)
+    finally:
+        release_db_connection(conn)
+
+# What qr_scan_steps asks its driver for, instead of doing the I/O itself
+WAIT_FOR_MESSAGE = 'wait'
+READ_SCAN_STATE = 'read'
+
+def qr_scan_steps(state, dumps):
+    # The QR stream without its I/O, driven by the Flask stream below and the
+    # async one in asgi.py. Yields text to send, (WAIT_FOR_MESSAGE, timeout) to
+    # be sent the next message or None once the timeout passes, and
+    # (READ_SCAN_STATE, None) to be sent the code's current state row.
+    scanned = state['scanned']
+    yield format_sse(dumps({'scanned': scanned}))
+    # Nothing can scan the code once it expires, stop waiting then
+    deadline = time.monotonic() + float(state['remaining'])
+    while not scanned:
+        timeout = min(SSE_HEARTBEAT, deadline - time.monotonic())
+        if timeout <= 0:
+            yield format_sse(dumps({'scanned': False}), event='expired')
+            return
+        message = yield (WAIT_FOR_MESSAGE, timeout)
+        if message is None:
+            if time.monotonic() < deadline:
+                yield ': keepalive\n\n'
+            continue
+        if message is RESYNC:
+            current = yield (READ_SCAN_STATE, None)
+            if not current:
+                # Deleted with its event or reaped, it can never be scanned
+                yield format_sse(dumps({'scanned': False}), event='expired')
+                return
+            scanned = current['scanned']
+        else:
+            scanned = message['scanned']
+        if scanned:
+            yield format_sse(dumps({'scanned': True}))
+
+@limit_streams
+def stream_qrid_scan_state(qrid, user_id):
+    key = 'qr:' + qrid
+    subscription = subscribe(key)
+    try:
+        state = _get_qr_scan_state(get_db(), qrid, user_id)
+    except Exception:
+        unsubscribe(key, subscription)
+        raise
+    if not state:
+        unsubscribe(key, subscription)
+        return dict(INVALID_QR)
+    steps = qr_scan_steps(state, current_app.json.dumps)
+
+    def stream():
+        try:
+            reply = None
+            while True:
+                try:
+                    step = steps.send(reply)
+                except StopIteration:
+                    return
+                reply = None
+                if isinstance(step, str):
+                    yield step
+                elif step[0] == WAIT_FOR_MESSAGE:
+                    try:
+                        reply = subscription.get(timeout=step[1])
+                    except queue.Empty:
+                        pass
+                else:
+                    reply = _qr_scan_state_now(qrid, user_id)
+        finally:
+            unsubscribe(key, subscription)
+    return sse_response(stream())
+
+def reap_expired_qr(grace_minutes=None, batch_size=QR_REAP_BATCH_SIZE):
+    if grace_minutes is None:
+        grace_minutes = float(os.getenv('QR_REAP_GRACE_MINUTES', '60'))
+    # Codes are kept a while after they expire so late scans still get the
+    # expired message, then deleted in small batches to keep locks short
+    conn = get_db_connection()
+    removed = 0
+    try:
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    DELETE FROM public.qr WHERE qrid IN (
+                        SELECT qrid FROM public.qr
+                        WHERE exp < now() - interval '1 minute' * %s
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    """,
+                    (grace_minutes, batch_size)
+                )
+                count = cur.rowcount
+            conn.commit()
+            removed += count
+            if count < batch_size:
+                break
+    finally:
+        release_db_connection(conn)
+    return removed
\ No newline at end of file
@@ -0,0 +1,29 @@
+CREATE TABLE
+  public.calendar_outbox (
+    id bigint GENERATED ALWAYS AS IDENTITY,
+    eid character(8) NOT NULL,
+    op character varying(16) NOT NULL,
+    payload jsonb NOT NULL DEFAULT '{}',
+    status character varying(16) NOT NULL DEFAULT 'pending',
+    attempts smallint NOT NULL DEFAULT 0,
+    next_attempt timestamp
+    with
+      time zone NOT NULL DEFAULT now(),
+      last_error text NULL,
+      created timestamp
+    with
+      time zone NOT NULL DEFAULT now(),
+      processed timestamp
+    with
+      time zone NULL
+  );
+
+ALTER TABLE
+  public.calendar_outbox
+ADD
+  CONSTRAINT calendar_outbox_pkey PRIMARY KEY (id);
+
+CREATE INDEX
+  calendar_outbox_pending_idx ON public.calendar_outbox (eid, id)
+WHERE
+  status = 'pending'
\ No newline at end of file
@@ -16,4 +16,7 @@ CREATE TABLE
 ALTER TABLE
   public.entries
 ADD
-  CONSTRAINT entries_pkey PRIMARY KEY (eid)
\ No newline at end of file
+  CONSTRAINT entries_pkey PRIMARY KEY (eid, uid);
+
+CREATE INDEX
+  entries_uid_idx ON public.entries (uid, eid) INCLUDE ("position", check_in, check_out)
\ No newline at end of file
@@ -0,0 +1,11 @@
+CREATE TABLE
+  public.event_occupancy (
+    eid character(8) NOT NULL,
+    filled integer NOT NULL DEFAULT 0,
+    reserve_filled integer NOT NULL DEFAULT 0
+  );
+
+ALTER TABLE
+  public.event_occupancy
+ADD
+  CONSTRAINT event_occupancy_pkey PRIMARY KEY (eid)
\ No newline at end of file
@@ -15,4 +15,7 @@ CREATE TABLE
 ALTER TABLE
   public.events
 ADD
-  CONSTRAINT events_pkey PRIMARY KEY (id)
\ No newline at end of file
+  CONSTRAINT events_pkey PRIMARY KEY (id);
+
+CREATE INDEX
+  events_start_idx ON public.events (start, id)
\ No newline at end of file
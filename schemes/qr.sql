@@ -12,4 +12,10 @@ CREATE TABLE
 ALTER TABLE
   public.qr
 ADD
-  CONSTRAINT qr_pkey PRIMARY KEY (qrid)
\ No newline at end of file
+  CONSTRAINT qr_pkey PRIMARY KEY (qrid);
+
+CREATE INDEX
+  qr_exp_idx ON public.qr (exp);
+
+CREATE INDEX
+  qr_eid_uid_idx ON public.qr (eid, uid)
\ No newline at end of file
@@ -0,0 +1,10 @@
+CREATE TABLE
+  public.resource_versions (
+    name character varying(64) NOT NULL,
+    version bigint NOT NULL DEFAULT 0
+  );
+
+ALTER TABLE
+  public.resource_versions
+ADD
+  CONSTRAINT resource_versions_pkey PRIMARY KEY (name)
\ No newline at end of file
@@ -1,12 +1,120 @@
-from db import get_db_connection
-
-def get_all_users():
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute('SELECT * FROM public.users')
-        users = cur.fetchall()
-    conn.close()
+import json
+import base64
+
+from flask import current_app, stream_with_context
+from psycopg import sql
+
+from db import get_db
+
+USER_FIELDS = ['id', 'last_name', 'first_name', 'nickname', 'grade', 'period', 'class']
+USERS_MAX_PAGE_SIZE = 1000
+USERS_STREAM_CHUNK = 500
+
+def _encode_user_cursor(user_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([user_id]).encode()).decode().rstrip('=')
+
+def _decode_user_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        user_id, = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError('Malformed cursor')
+    if not isinstance(user_id, str):
+        raise ValueError('Malformed cursor')
+    return user_id
+
+def _split_arg(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+def _invalid_users_query(friendly):
     return {
-        'success': True,
-        'users': users
-    }
\ No newline at end of file
+        'success': False,
+        'error': 'Invalid Users Query',
+        'friendly': friendly
+    }
+
+def _build_users_query(args):
+    fields = USER_FIELDS
+    if args.get('fields'):
+        fields = list(dict.fromkeys(_split_arg(args['fields'])))
+        unknown = [field for field in fields if field not in USER_FIELDS]
+        if unknown:
+            raise ValueError('Unknown user fields: ' + ', '.join(unknown))
+    # The keyset needs the id even when it was not asked for, it is dropped
+    # from the rows again on the way out
+    selected = fields if 'id' in fields else fields + ['id']
+    drop_id = selected is not fields
+
+    conditions = []
+    params = []
+    for column in ('grade', 'period'):
+        if args.get(column):
+            try:
+                values = [int(value) for value in _split_arg(args[column])]
+            except ValueError:
+                raise ValueError(f'The {column} filter must be a list of numbers.')
+            conditions.append(sql.SQL('{} = ANY(%s)').format(sql.Identifier(column)))
+            params.append(values)
+    if args.get('class'):
+        conditions.append(sql.SQL('class = ANY(%s)'))
+        params.append(_split_arg(args['class']))
+    if args.get('cursor'):
+        try:
+            conditions.append(sql.SQL('id > %s'))
+            params.append(_decode_user_cursor(args['cursor']))
+        except ValueError:
+            raise ValueError('The requested page of users could not be found, try refreshing the page.')
+
+    page_size = None
+    if args.get('pageSize'):
+        try:
+            page_size = min(max(int(args['pageSize']), 1), USERS_MAX_PAGE_SIZE)
+        except ValueError:
+            raise ValueError('The page size must be a number.')
+
+    query = sql.SQL('SELECT {} FROM public.users').format(sql.SQL(', ').join(map(sql.Identifier, selected)))
+    if conditions:
+        query += sql.SQL(' WHERE ') + sql.SQL(' AND ').join(conditions)
+    query += sql.SQL(' ORDER BY id')
+    if page_size is not None:
+        # One row past the page tells whether another page follows
+        query += sql.SQL(' LIMIT %s')
+        params.append(page_size + 1)
+    return query, params, drop_id, page_size
+
+# Without pageSize every matching user is streamed, with it one page is
+# streamed followed by nextCursor. Rows go out in chunks from a server side
+# cursor so memory does not grow with enrollment.
+def get_all_users(args=None):
+    try:
+        query, params, drop_id, page_size = _build_users_query(args or {})
+    except ValueError as e:
+        return _invalid_users_query(str(e))
+    dumps = current_app.json.dumps
+
+    def stream():
+        conn = get_db()
+        with conn.cursor(name='users_stream') as cur:
+            cur.execute(query, params)
+            yield '{"success": true, "users": ['
+            sent = 0
+            last_id = None
+            next_cursor = None
+            while True:
+                rows = cur.fetchmany(USERS_STREAM_CHUNK)
+                if not rows:
+                    break
+                if page_size is not None and sent + len(rows) > page_size:
+                    rows = rows[:page_size - sent]
+                    next_cursor = _encode_user_cursor(rows[-1]['id'] if rows else last_id)
+                if rows:
+                    last_id = rows[-1]['id']
+                    if drop_id:
+                        for row in rows:
+                            del row['id']
+                    yield (', ' if sent else '') + ', '.join(dumps(row) for row in rows)
+                    sent += len(rows)
+                if next_cursor:
+                    break
+            yield '], "nextCursor": ' + dumps(next_cursor) + '}'
+    return current_app.response_class(stream_with_context(stream()), mimetype='application/json')
\ No newline at end of file
@@ -0,0 +1,44 @@
+import psycopg
+
+from db import get_db
+from notify import publish
+
+# Resources are event:<id> for an event and its entries, and users for the
+# user table. The event list has no row of its own, its version is the sum of
+# every event's so it changes whenever any of them commits a bump. Bumps are
+# also published on the versions key for the response cache.
+
+# Rows are locked in sorted order so two writers can never deadlock
+BUMP_VERSIONS_SQL = """
+    INSERT INTO public.resource_versions AS current (name, version)
+    SELECT name, 1 FROM unnest(%s::text[]) AS name ORDER BY name
+    ON CONFLICT (name) DO UPDATE SET version = current.version + 1
+"""
+
+def bump_versions(*names, conn: psycopg.Connection = None):
+    if conn is None:
+        conn = get_db()
+    names = sorted(set(names))
+    conn.execute(BUMP_VERSIONS_SQL, (names, ))
+    publish('versions', {'names': names}, conn=conn)
+
+def bump_all_events(conn: psycopg.Connection = None):
+    if conn is None:
+        conn = get_db()
+    conn.execute("UPDATE public.resource_versions SET version = version + 1 WHERE name LIKE 'event:%'")
+    publish('versions', {'names': ['event:*']}, conn=conn)
+
+def get_versions(names):
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT name, version FROM public.resource_versions WHERE name = ANY(%(names)s)
+            UNION ALL
+            SELECT 'events', coalesce(sum(version), 0) FROM public.resource_versions
+            WHERE name LIKE 'event:%%' AND 'events' = ANY(%(names)s)
+            """,
+            {'names': list(names)}
+        )
+        versions = {row['name']: row['version'] for row in cur.fetchall()}
+    return {name: versions.get(name, 0) for name in names}
\ No newline at end of file
@@ -0,0 +1,5 @@
+# Entry point for production WSGI servers, see gunicorn.conf.py. With
+# preload_app the master imports this once and the workers fork from it, so
+# nothing here may open connections or start threads; the pool, the notify
+# listener and the response cache callbacks start lazily in each worker.
+from main import app
\ No newline at end of file